@@ -32,6 +32,11 @@ setup(
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     download-users = presence_analyzer.utils:download_users_xml
+    export-stats = presence_analyzer.utils:export_statistics
+    compile-snapshot = presence_analyzer.snapshot:compile_snapshot
+    generate-data = presence_analyzer.benchmark:generate
+    benchmark = presence_analyzer.benchmark:run
+    startup-profile = presence_analyzer.startup:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -3,4 +3,12 @@
 Presence analyzer.
 """
 from .main import app
-from . import views
+
+
+def create_app():
+    """
+    Returns the application with its views registered.
+    Views, and modules they use, are imported on the first call only.
+    """
+    from . import views  # pylint: disable=unused-variable
+    return app
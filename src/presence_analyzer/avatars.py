@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Avatars of users proxied from intranet and cached on disk.
+"""
+import imghdr
+import logging
+import os
+
+from contextlib import closing
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import download, get_users_data, http_session
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# avatars proxied from intranet, kept in browsers for a week and fetched
+# by at most AVATAR_WORKERS threads; requests.Session keeps 10 connections
+AVATAR_MAX_AGE = 7 * 24 * 3600
+AVATAR_TIMEOUT = 5
+AVATAR_WORKERS = 8
+
+avatars_cache = {}  # pylint: disable=invalid-name
+
+
+def avatars_path():
+    """
+    Path of avatars cache directory.
+    :return string:
+    """
+    return app.config.get('AVATARS_DIR') or os.path.join(
+        os.path.dirname(app.config['USERS_DATA']), 'avatars'
+    )
+
+
+def avatar_path(user_id):
+    """
+    Path of cached avatar of given user.
+    :param integer user_id:
+    :return string:
+    """
+    return os.path.join(avatars_path(), str(user_id))
+
+
+def cached_avatars():
+    """
+    Ids of users with cached avatar, listed again when the directory
+    changes.
+    :return frozenset:
+    """
+    directory = avatars_path()
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return frozenset()
+
+    cached = avatars_cache.get(directory)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, frozenset(
+            int(name) for name in os.listdir(directory) if name.isdigit()
+        ))
+        avatars_cache[directory] = cached
+    return cached[1]
+
+
+def avatars_version():
+    """
+    Version of avatars cache, changes with directory mtime.
+    :return string:
+    """
+    cached_avatars()
+    cached = avatars_cache.get(avatars_path())
+    return 'none' if cached is None else repr(cached[0])
+
+
+def avatar_mimetype(path):
+    """
+    Content type of image file.
+    :param string path:
+    :return string:
+    """
+    kind = imghdr.what(path)
+    return 'application/octet-stream' if kind is None else 'image/' + kind
+
+
+def fetch_avatar(user_id, url, session=None):
+    """
+    Downloads avatar of given user to the cache unless it is unchanged.
+    :param integer user_id:
+    :param string url:
+    :param requests.Session session: new session with one retry if None
+    :return boolean: whether the avatar was downloaded
+    :raises requests.RequestException: when download fails
+    """
+    directory = avatars_path()
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # created by another thread meanwhile
+            if not os.path.isdir(directory):
+                raise
+    path = avatar_path(user_id)
+    if session is None:
+        with closing(http_session(retries=1)) as session:
+            return download(url, path, session, AVATAR_TIMEOUT)
+    return download(url, path, session, AVATAR_TIMEOUT)
+
+
+def cached_avatar(user_id):
+    """
+    Path of cached avatar of given user, fetched when missing.
+    :param integer user_id:
+    :return string: None when user is unknown or fetch failed
+    """
+    path = avatar_path(user_id)
+    if os.path.exists(path):
+        return path
+
+    users = get_users_data()
+    if user_id not in users:
+        return None
+    import requests
+    try:
+        fetch_avatar(user_id, users[user_id]['avatar'])
+    except (requests.RequestException, EnvironmentError) as error:
+        log.warning('Cannot fetch avatar of %s: %s', user_id, error)
+        return None
+    return path
+
+
+def download_avatars(users, session, workers=AVATAR_WORKERS):
+    """
+    Fetches avatars of users to the cache with at most `workers` threads,
+    cached avatars are revalidated with conditional requests.
+    :param dict users: result of get_users_data
+    :param requests.Session session:
+    :param integer workers:
+    :return dict: numbers of downloaded, not modified and failed avatars
+    """
+    from multiprocessing.pool import ThreadPool
+    import requests
+
+    def fetch(item):
+        """
+        Fetches one avatar.
+        """
+        user_id, user = item
+        try:
+            if fetch_avatar(user_id, user['avatar'], session):
+                return 'downloaded'
+            return 'not_modified'
+        except (requests.RequestException, EnvironmentError) as error:
+            log.warning('Cannot fetch avatar of %s: %s', user_id, error)
+            return 'failed'
+
+    result = dict.fromkeys(('downloaded', 'not_modified', 'failed'), 0)
+    pool = ThreadPool(workers)
+    try:
+        for outcome in pool.imap_unordered(fetch, users.items()):
+            result[outcome] += 1
+    finally:
+        pool.close()
+        pool.join()
+    return result
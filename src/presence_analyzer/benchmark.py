@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic presence data and benchmarks of loading and serving it.
+
+Every dataset size is benchmarked in a forked process, so peak memory and
+caches of one size do not leak into the next one.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from datetime import date, timedelta
+
+from presence_analyzer import create_app, utils
+from presence_analyzer.ingest import read_presence
+
+# last second of a day
+DAY_END = 24 * 3600 - 1
+# endpoints timed for every dataset, {user_id} is replaced by sampled users
+ENDPOINTS = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/{user_id}',
+    '/api/v1/presence_weekday/{user_id}',
+    '/api/v1/presence_start_end/{user_id}',
+    '/api/v1/percentile_weekday/{user_id}',
+    '/api/v1/presence_trend/{user_id}?period=month',
+    '/api/v1/presence_weekday/{user_id}?from=2013-03-01&to=2013-06-30',
+    '/api/v1/org/presence_weekday',
+    '/api/v1/batch?stats=presence_weekday',
+)
+
+
+def format_seconds(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    :param integer seconds:
+    :return string:
+    """
+    minutes, second = divmod(seconds, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        minutes // 60, minutes % 60, second
+    )
+
+
+def generate_presence(path, users=100, days=250, first_day=date(2013, 1, 1),
+                      start=(8.5 * 3600, 3600), length=(8 * 3600, 3600),
+                      absence=0.1, seed=0):
+    """
+    Writes presence CSV with `days` working days of every user, rows sorted
+    by user and date as in exported files. Starts and lengths of presence
+    are normally distributed, given as (mean, deviation) in seconds, and
+    working day is skipped with `absence` probability.
+    :return integer: number of written rows
+    """
+    generator = random.Random(seed)
+    working_days = []
+    day = first_day
+    while len(working_days) < days:
+        if day.weekday() < 5:
+            working_days.append(day.isoformat())
+        day += timedelta(days=1)
+
+    rows = 0
+    with open(path, 'wb') as stream:
+        for user_id in xrange(10, 10 + users):
+            lines = []
+            for day in working_days:
+                if generator.random() < absence:
+                    continue
+                begin = min(max(int(generator.gauss(*start)), 0), DAY_END)
+                end = min(begin + max(int(generator.gauss(*length)), 0),
+                          DAY_END)
+                lines.append('{0},{1},{2},{3}\n'.format(
+                    user_id, day, format_seconds(begin), format_seconds(end)
+                ))
+            stream.writelines(lines)
+            rows += len(lines)
+    return rows
+
+
+def generate_users(path, users=100):
+    """
+    Writes users.xml describing `users` users.
+    :param string path:
+    :param integer users:
+    """
+    with open(path, 'wb') as stream:
+        stream.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<intranet>\n'
+            '  <server>\n    <host>intranet.example.com</host>\n'
+            '    <port>443</port>\n    <protocol>https</protocol>\n'
+            '  </server>\n  <users>\n'
+        )
+        for user_id in xrange(10, 10 + users):
+            stream.write(
+                '    <user id="{0}">\n'
+                '      <avatar>/api/images/users/{0}</avatar>\n'
+                '      <name>User {0}</name>\n'
+                '    </user>\n'.format(user_id)
+            )
+        stream.write('  </users>\n</intranet>\n')
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls function and measures its wall time.
+    :return tuple: result and seconds
+    """
+    started = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - started
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of values.
+    :param list values:
+    :param float fraction:
+    :return float:
+    """
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def benchmark_dataset(directory, users, days, requests=20, seed=0):
+    """
+    Generates dataset in directory and measures parsing, loading and
+    serving it.
+    :return dict: measurements
+    """
+    app = create_app()
+    path = os.path.join(directory, 'data.csv')
+    users_path = os.path.join(directory, 'users.xml')
+    rows, generate_time = timed(generate_presence, path, users, days,
+                                date(2013, 1, 1), (8.5 * 3600, 3600),
+                                (8 * 3600, 3600), 0.1, seed)
+    generate_users(users_path, users)
+    size = os.path.getsize(path)
+    report = {'users': users, 'rows': rows, 'bytes': size,
+              'generate_s': generate_time}
+
+    parser, parse_time = timed(read_presence, path)
+    _, index_time = timed(parser.store)
+    report.update({
+        'parse_s': parse_time,
+        'index_s': index_time,
+        'parse_rows_per_s': rows / parse_time if parse_time else 0,
+        'parse_mb_per_s': size / parse_time / 1e6 if parse_time else 0,
+    })
+    del parser
+
+    app.config.update({
+        'DATA_CSV': path,
+        'DATA_SNAPSHOT': None,
+        'USERS_DATA': users_path,
+        'TEAMS_DATA': os.path.join(directory, 'teams.json'),
+    })
+    utils.data_cache.clear()
+    utils.loaders.clear()
+    _, cold_time = timed(utils.get_data)
+    _, warm_time = timed(utils.get_data)
+    report.update({
+        'get_data_cold_s': cold_time,
+        'get_data_warm_s': warm_time,
+    })
+
+    client = app.test_client()
+    headers = {'X-Requested-With': 'XMLHttpRequest'}
+    sampler = random.Random(seed)
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        latencies = []
+        for _ in xrange(requests):
+            url = endpoint.format(user_id=sampler.randint(10, 9 + users))
+            response, latency = timed(client.get, url, headers=headers)
+            if response.status_code != 200:
+                raise RuntimeError('{0} returned {1}'.format(
+                    url, response.status_code
+                ))
+            latencies.append(latency)
+        endpoints[endpoint] = {
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p90_ms': percentile(latencies, 0.9) * 1000,
+            'max_ms': max(latencies) * 1000,
+        }
+    report['endpoints'] = endpoints
+    report['cache'] = dict(utils.data_cache.stats)
+    # kilobytes on Linux
+    report['peak_rss_mb'] = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss / 1024.0
+    return report
+
+
+def isolated(function, *args):
+    """
+    Runs function in forked process and returns its JSON result.
+    :return mixed:
+    """
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(reader)
+        code = 0
+        try:
+            with os.fdopen(writer, 'wb') as stream:
+                json.dump(function(*args), stream)
+        except Exception:  # pylint: disable=broad-except
+            code = 1
+            sys.excepthook(*sys.exc_info())
+        finally:
+            os._exit(code)  # pylint: disable=protected-access
+
+    os.close(writer)
+    with os.fdopen(reader, 'rb') as stream:
+        result = stream.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('Benchmark process failed')
+    return json.loads(result)
+
+
+def print_report(reports, stream=sys.stdout):
+    """
+    Prints measurements of datasets side by side.
+    :param list reports:
+    :param file stream:
+    """
+    def line(name, values, pattern='{0:>14.3f}'):
+        """
+        Prints one measurement of every dataset.
+        """
+        stream.write('{0:<64}'.format(name))
+        stream.write(''.join(pattern.format(value) for value in values))
+        stream.write('\n')
+
+    integer = '{0:>14d}'
+    line('users', [report['users'] for report in reports], integer)
+    line('rows', [report['rows'] for report in reports], integer)
+    line('bytes', [report['bytes'] for report in reports], integer)
+    for name in ('parse_s', 'index_s', 'parse_rows_per_s', 'parse_mb_per_s',
+                 'get_data_cold_s', 'get_data_warm_s', 'peak_rss_mb'):
+        line(name, [report[name] for report in reports])
+    for endpoint in ENDPOINTS:
+        for name in ('p50_ms', 'p90_ms'):
+            line('{0} {1}'.format(endpoint[8:], name), [
+                report['endpoints'][endpoint][name] for report in reports
+            ])
+    for name in sorted(reports[0]['cache']):
+        line('cache ' + name, [report['cache'][name] for report in reports],
+             integer)
+
+
+def run(argv=None):
+    """
+    Benchmarks loading and serving synthetic datasets of given sizes.
+    """
+    parser = argparse.ArgumentParser(description=run.__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 1000],
+                        help='numbers of users of datasets')
+    parser.add_argument('--days', type=int, default=250,
+                        help='working days of every user')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests timed per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='print measurements as JSON')
+    args = parser.parse_args(argv)
+
+    reports = []
+    for users in args.users:
+        directory = tempfile.mkdtemp()
+        try:
+            reports.append(isolated(
+                benchmark_dataset, directory, users, args.days,
+                args.requests, args.seed
+            ))
+        finally:
+            shutil.rmtree(directory)
+    if args.json:
+        json.dump(reports, sys.stdout, indent=2, sort_keys=True)
+    else:
+        print_report(reports)
+    return reports
+
+
+def generate(argv=None):
+    """
+    Writes synthetic presence CSV and users.xml files.
+    """
+    parser = argparse.ArgumentParser(description=generate.__doc__)
+    parser.add_argument('data_csv')
+    parser.add_argument('users_xml')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=250,
+                        help='working days of every user')
+    parser.add_argument('--first-day', default='2013-01-01',
+                        help='YYYY-MM-DD')
+    parser.add_argument('--start', type=float, nargs=2,
+                        default=(8.5 * 3600, 3600), metavar=('MEAN', 'DEV'),
+                        help='start of presence in seconds since midnight')
+    parser.add_argument('--length', type=float, nargs=2,
+                        default=(8 * 3600, 3600), metavar=('MEAN', 'DEV'),
+                        help='length of presence in seconds')
+    parser.add_argument('--absence', type=float, default=0.1,
+                        help='probability of missing working day')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    first_day = date(*map(int, args.first_day.split('-')))
+    rows = generate_presence(
+        args.data_csv, args.users, args.days, first_day, tuple(args.start),
+        tuple(args.length), args.absence, args.seed
+    )
+    generate_users(args.users_xml, args.users)
+    print 'Generated {0} rows of {1} users'.format(rows, args.users)
@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+Fast ingestion of presence CSV files.
+"""
+import glob
+import logging
+import os
+import time
+
+from array import array
+from datetime import date
+from hashlib import md5
+from threading import Lock
+
+from presence_analyzer.metrics import registry
+from presence_analyzer.snapshot import (
+    SnapshotError,
+    read_snapshot,
+    write_snapshot
+)
+from presence_analyzer.store import PresenceStore, WeekdayOrder
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+CHUNK_SIZE = 1 << 20
+# limits of user ids stored in 32-bit integer columns
+USER_ID_RANGE = (-1 << 31, (1 << 31) - 1)
+
+
+class PresenceParser(object):
+    """
+    Parses `id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS` lines into typed columns.
+
+    Dates and times repeat a lot across users, so every distinct field
+    is converted once and then looked up in a memo dictionary.
+    """
+
+    def __init__(self, offset=0, line=1):
+        self.columns = tuple(array(PresenceStore.typecode) for _ in xrange(4))
+        self.errors = []
+        self.offset = offset
+        self.line = line
+        self._days = {}
+        self._seconds = {}
+
+    def parse_day(self, field):
+        """
+        Converts YYYY-MM-DD to day ordinal.
+        """
+        try:
+            return self._days[field]
+        except KeyError:
+            if len(field) != 10 or field[4] != '-' or field[7] != '-':
+                raise ValueError('Invalid date {0!r}'.format(field))
+            day = date(
+                int(field[0:4]), int(field[5:7]), int(field[8:10])
+            ).toordinal()
+            self._days[field] = day
+            return day
+
+    def parse_seconds(self, field):
+        """
+        Converts HH:MM:SS to seconds since midnight.
+        """
+        try:
+            return self._seconds[field]
+        except KeyError:
+            if len(field) != 8 or field[2] != ':' or field[5] != ':':
+                raise ValueError('Invalid time {0!r}'.format(field))
+            hour, minute, second = (
+                int(field[0:2]), int(field[3:5]), int(field[6:8])
+            )
+            if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+                raise ValueError('Invalid time {0!r}'.format(field))
+            seconds = hour * 3600 + minute * 60 + second
+            self._seconds[field] = seconds
+            return seconds
+
+    def parse_lines(self, lines, first_line):
+        """
+        Appends values of given lines to columns.
+        Malformed lines are skipped and remembered with their numbers.
+        """
+        user_ids, days, starts, ends = self.columns
+        parse_day, parse_seconds = self.parse_day, self.parse_seconds
+        for number, line in enumerate(lines, first_line):
+            line = line.rstrip('\r')
+            if not line:
+                continue
+            try:
+                user_id, day, start, end = line.split(',')
+                row = (
+                    int(user_id),
+                    parse_day(day),
+                    parse_seconds(start),
+                    parse_seconds(end),
+                )
+                if not USER_ID_RANGE[0] <= row[0] <= USER_ID_RANGE[1]:
+                    raise ValueError('Invalid user id {0!r}'.format(user_id))
+            except ValueError:
+                log.debug('Problem with line %d: %r', number, line)
+                self.errors.append((number, line))
+                continue
+
+            user_ids.append(row[0])
+            days.append(row[1])
+            starts.append(row[2])
+            ends.append(row[3])
+
+    def parse_stream(self, stream, chunk_size=CHUNK_SIZE, flush=None):
+        """
+        Parses stream in chunks of complete lines.
+
+        `offset` is moved past the last newline, so an unterminated last
+        line is parsed but will be read again by the next parse.
+        With `flush` columns are passed to it and emptied after every
+        chunk, so memory does not grow with the stream.
+        """
+        pending = ''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            chunk = pending + chunk
+            lines = chunk.split('\n')
+            pending = lines.pop()
+            self.parse_lines(lines, self.line)
+            self.line += len(lines)
+            self.offset += len(chunk) - len(pending)
+            if flush is not None:
+                self.flush(flush)
+        if pending:
+            self.parse_lines([pending], self.line)
+        if flush is not None:
+            self.flush(flush)
+
+    def flush(self, flush):
+        """
+        Passes parsed columns to flush and starts new ones.
+        """
+        flush(self.columns)
+        self.columns = tuple(array(PresenceStore.typecode) for _ in xrange(4))
+
+    def store(self):
+        """
+        Returns PresenceStore with parsed rows.
+        """
+        return PresenceStore.from_columns(*self.columns)
+
+
+def read_presence(path, chunk_size=CHUNK_SIZE):
+    """
+    Parses presence CSV file into PresenceParser.
+    """
+    parser = PresenceParser()
+    with open(path, 'rb') as stream:
+        parser.parse_stream(stream, chunk_size)
+    return parser
+
+
+class PresenceLoader(object):
+    """
+    Keeps presence data of append-only CSV file up to date.
+
+    The file identity and the offset of its last parsed line are
+    remembered, so when the file only grew just the appended tail is
+    parsed and merged into previous data. Truncated or replaced files
+    are parsed from scratch.
+
+    With `snapshot` path the first load maps binary snapshot of the file
+    instead of parsing it, the snapshot is rebuilt when the file changed.
+    """
+    # bytes before parsed offset compared to detect in place rewrites
+    GUARD_SIZE = 64
+
+    def __init__(self, path, snapshot=None):
+        self.path = path
+        self.snapshot = snapshot
+        self.lock = Lock()
+        self.identity = None
+        self.offset = 0
+        self.line = 1
+        self.guard = ''
+        self.data = None
+
+    def load(self):
+        """
+        Returns PresenceStore of current file content.
+        """
+        with self.lock:
+            identity = self.stat()
+            if self.data is None and self.snapshot:
+                self.restore(identity)
+            if self.data is None or identity != self.identity:
+                self.parse(identity)
+            return self.data
+
+    def stat(self):
+        """
+        Returns identity of the file.
+        """
+        stat = os.stat(self.path)
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def parse(self, identity):
+        """
+        Parses appended tail or whole file.
+        """
+        started = time.time()
+        with open(self.path, 'rb') as stream:
+            appended = self.is_appended(stream, identity)
+            if appended:
+                parser = PresenceParser(self.offset, self.line)
+                stream.seek(self.offset)
+                parser.parse_stream(stream)
+                data = self.data.merge(parser.store())
+                log.debug(
+                    'Merged %d rows appended to %s',
+                    len(parser.columns[0]), self.path
+                )
+            else:
+                parser = PresenceParser()
+                stream.seek(0)
+                parser.parse_stream(stream)
+                data = parser.store()
+                log.debug('Loaded %d rows from %s', len(data), self.path)
+            self.read_guard(stream, parser.offset)
+
+        registry.observe_load(
+            'append' if appended else 'full',
+            time.time() - started,
+            len(parser.columns[0]),
+        )
+        self.identity = identity
+        self.offset, self.line = parser.offset, parser.line
+        self.set_data(data)
+
+    def set_data(self, data):
+        """
+        Stores data stamped with version of current file identity.
+        """
+        data.version = '{0:x}-{1:x}-{2:x}'.format(
+            self.identity[1], self.identity[2], int(self.identity[3] * 1000000)
+        )
+        self.data = data
+
+    def state(self):
+        """
+        Returns parsing state kept in snapshots.
+        """
+        return {
+            'identity': self.identity,
+            'offset': self.offset,
+            'line': self.line,
+            'guard': self.guard,
+        }
+
+    def set_state(self, data, state):
+        """
+        Continues from data and parsing state read from snapshot.
+        """
+        self.identity = state['identity']
+        self.offset, self.line = state['offset'], state['line']
+        self.guard = state['guard']
+        self.set_data(data)
+
+    def restore(self, identity):
+        """
+        Maps snapshot of the file, bringing it up to date when file changed.
+        """
+        started = time.time()
+        try:
+            self.set_state(*read_snapshot(self.snapshot))
+            registry.observe_load('snapshot', time.time() - started, 0)
+        except (IOError, OSError, SnapshotError):
+            log.info('Snapshot %s is missing or invalid', self.snapshot)
+        if self.data is not None and identity == self.identity:
+            return
+
+        self.parse(identity)
+        try:
+            write_snapshot(self.snapshot, self.data, self.state())
+            self.set_state(*read_snapshot(self.snapshot))
+        except (IOError, OSError):
+            log.warning(
+                'Cannot write snapshot %s', self.snapshot, exc_info=True
+            )
+
+    def build_snapshot(self):
+        """
+        Parses the whole file and writes its snapshot.
+        """
+        with self.lock:
+            self.data = None
+            self.parse(self.stat())
+            write_snapshot(self.snapshot, self.data, self.state())
+            log.info('Snapshot %s written', self.snapshot)
+            return self.data
+
+    def is_appended(self, stream, identity):
+        """
+        Checks whether file is the previously parsed one with new lines.
+        """
+        if self.data is None or identity[:2] != self.identity[:2]:
+            return False
+        if identity[2] < self.identity[2]:
+            log.info('File %s was truncated', self.path)
+            return False
+        stream.seek(max(self.offset - self.GUARD_SIZE, 0))
+        if stream.read(min(self.offset, self.GUARD_SIZE)) != self.guard:
+            log.info('File %s was rewritten', self.path)
+            return False
+        return True
+
+    def read_guard(self, stream, offset):
+        """
+        Remembers bytes preceding given offset.
+        """
+        stream.seek(max(offset - self.GUARD_SIZE, 0))
+        self.guard = stream.read(min(offset, self.GUARD_SIZE))
+
+
+def expand_paths(pattern):
+    """
+    Paths of presence files given as path, glob or list of them.
+    Glob matches are sorted, repeated paths are skipped.
+    :param mixed pattern: string or list of strings
+    :return list:
+    """
+    patterns = [pattern] if isinstance(pattern, basestring) else pattern
+    paths = []
+    for item in patterns:
+        matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def make_loader(pattern, snapshot=None, processes=None):
+    """
+    Loader of single presence file or of files matching pattern.
+    :param mixed pattern: path, glob or list of them
+    :param string snapshot: snapshot path, used for single file only
+    :param integer processes: size of process pool of ShardedLoader
+    :return PresenceLoader or ShardedLoader:
+    """
+    if isinstance(pattern, basestring) and not glob.has_magic(pattern):
+        return PresenceLoader(pattern, snapshot)
+    return ShardedLoader(pattern, processes)
+
+
+def parse_shard(path):
+    """
+    Parses and indexes file, run in worker process of ShardedLoader.
+    Columns are returned as strings, much cheaper to pickle than arrays.
+    :param string path:
+    :return tuple: loader state, columns, offsets, weekdays and seconds
+    """
+    started = time.time()
+    loader = PresenceLoader(path)
+    data = loader.load()
+    columns = (data.user_ids, data.days, data.starts, data.ends) + data.order
+    return (
+        loader.state(),
+        [(column.typecode, column.tostring()) for column in columns],
+        data.offsets,
+        data.weekdays,
+        time.time() - started,
+    )
+
+
+def load_shard(path, result):
+    """
+    PresenceLoader continuing from parse_shard result.
+    :param string path:
+    :param tuple result:
+    :return PresenceLoader:
+    """
+    state, strings, offsets, weekdays, seconds = result
+    columns = []
+    for typecode, string in strings:
+        column = array(typecode)
+        column.fromstring(string)
+        columns.append(column)
+    data = PresenceStore(
+        *columns[:4],
+        offsets=offsets,
+        weekdays=weekdays,
+        order=WeekdayOrder(*columns[4:])
+    )
+    registry.observe_load('shard', seconds, len(data))
+    loader = PresenceLoader(path)
+    loader.set_state(data, state)
+    return loader
+
+
+class ShardedLoader(object):
+    """
+    Keeps presence data of many CSV files up to date.
+
+    Files are merged in order of expand_paths, rows of later files
+    override rows of earlier ones for the same user and date. New files
+    are parsed and indexed in a pool of `processes` processes (all cores
+    by default), changed files by their PresenceLoader, so appended lines
+    are parsed only, and unchanged files are reused.
+    """
+
+    def __init__(self, pattern, processes=None):
+        self.pattern = pattern
+        self.processes = processes
+        self.lock = Lock()
+        self.loaders = {}
+        self.identity = None
+        self.data = None
+
+    def stat(self):
+        """
+        Returns paths and identities of the files.
+        """
+        result = []
+        for path in expand_paths(self.pattern):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                log.warning('File %s disappeared', path)
+                continue
+            result.append((
+                path,
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+            ))
+        return tuple(result)
+
+    def load(self):
+        """
+        Returns PresenceStore of current content of the files.
+        """
+        with self.lock:
+            identity = self.stat()
+            if self.data is not None and identity == self.identity:
+                return self.data
+
+            paths = [path for path, _ in identity]
+            for path in set(self.loaders) - set(paths):
+                del self.loaders[path]
+            for path in paths:
+                if path in self.loaders:
+                    self.loaders[path].load()
+            self.parse([path for path in paths if path not in self.loaders])
+
+            data = PresenceStore()
+            for path in paths:
+                data = data.merge(self.loaders[path].data)
+            data.version = md5('\n'.join(
+                self.loaders[path].data.version for path in paths
+            )).hexdigest()
+            log.debug('Merged %d rows of %d files', len(data), len(paths))
+            self.identity, self.data = identity, data
+            return data
+
+    def parse(self, paths):
+        """
+        Parses new files, in parallel when there are many of them.
+        """
+        import multiprocessing
+
+        processes = min(self.processes or multiprocessing.cpu_count(),
+                        len(paths))
+        if processes < 2:
+            for path in paths:
+                self.loaders[path] = PresenceLoader(path)
+                self.loaders[path].load()
+            return
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(parse_shard, paths, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        for path, result in zip(paths, results):
+            self.loaders[path] = load_shard(path, result)
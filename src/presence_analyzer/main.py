@@ -1,6 +1,50 @@
 """
 Flask app initialization.
 """
-from flask import Flask
+from time import time
+
+from flask import Flask, g, request
+from presence_analyzer.metrics import registry
 
 app = Flask(__name__)  # pylint: disable=invalid-name
+
+
+@app.before_request
+def start_request():
+    """
+    Remembers start time of the request.
+    """
+    g.started = time()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records latency, status and size of the response in metrics.
+    Streamed bodies are not measured, nor consumed here.
+    """
+    started = getattr(g, 'started', None)
+    if started is not None:
+        g.recorded = True
+        registry.observe_request(
+            request.endpoint or 'unknown',
+            response.status_code,
+            time() - started,
+            None if response.is_streamed
+            else response.calculate_content_length(),
+        )
+    return response
+
+
+@app.teardown_request
+def record_failure(exception):
+    """
+    Records request failed with unhandled exception as 500, after_request
+    hooks are not called for it.
+    """
+    started = getattr(g, 'started', None)
+    if exception is not None and started is not None and \
+            not getattr(g, 'recorded', False):
+        registry.observe_request(
+            request.endpoint or 'unknown', 500, time() - started, None
+        )
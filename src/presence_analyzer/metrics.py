@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Request, data loading and cache metrics in Prometheus text format.
+
+Every process keeps its own metrics, so with pre-forked workers each
+worker reports requests it served.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+PREFIX = 'presence_analyzer_'
+# upper bounds of histogram buckets, +Inf is added
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+SIZE_BUCKETS = (
+    128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304
+)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        Counts value in its bucket.
+        :param float value:
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        """
+        Yields lines of buckets, sum and count.
+        :param string name:
+        :param string labels: rendered labels without braces
+        :return generator:
+        """
+        separator = ',' if labels else ''
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield '{0}_bucket{{{1}{2}le="{3}"}} {4}'.format(
+                name, labels, separator, bound, total
+            )
+        labels = '{{{0}}}'.format(labels) if labels else ''
+        yield '{0}_sum{1} {2!r}'.format(name, labels, float(self.sum))
+        yield '{0}_count{1} {2}'.format(name, labels, total)
+
+
+class Metrics(object):
+    """
+    Thread safe registry of collected metrics.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latency = {}
+        self.sizes = {}
+        self.statuses = defaultdict(int)
+        self.loads = defaultdict(int)
+        self.load_seconds = defaultdict(float)
+        self.rows = defaultdict(int)
+
+    def observe_request(self, endpoint, status, seconds, size):
+        """
+        Records handled request.
+        :param string endpoint:
+        :param integer status:
+        :param float seconds:
+        :param integer size: body size or None when streamed
+        """
+        with self.lock:
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(LATENCY_BUCKETS)
+                self.sizes[endpoint] = Histogram(SIZE_BUCKETS)
+            self.latency[endpoint].observe(seconds)
+            if size is not None:
+                self.sizes[endpoint].observe(size)
+            self.statuses[endpoint, status] += 1
+
+    def observe_load(self, kind, seconds, rows):
+        """
+        Records parse of presence data.
+        :param string kind: full, append or snapshot
+        :param float seconds:
+        :param integer rows: rows parsed
+        """
+        with self.lock:
+            self.loads[kind] += 1
+            self.load_seconds[kind] += seconds
+            self.rows[kind] += rows
+
+    def render(self, cache_stats=None):
+        """
+        Renders metrics in Prometheus text exposition format.
+        :param dict cache_stats: counters of utils.LRUCache
+        :return string:
+        """
+        lines = []
+
+        def header(name, kind, text):
+            """
+            Adds HELP and TYPE lines.
+            """
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, text))
+            lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+
+        with self.lock:
+            header('request_duration_seconds', 'histogram',
+                   'Time of handling requests.')
+            for endpoint in sorted(self.latency):
+                lines.extend(self.latency[endpoint].samples(
+                    PREFIX + 'request_duration_seconds',
+                    'endpoint="{0}"'.format(endpoint)
+                ))
+            header('response_size_bytes', 'histogram',
+                   'Size of not streamed response bodies.')
+            for endpoint in sorted(self.sizes):
+                lines.extend(self.sizes[endpoint].samples(
+                    PREFIX + 'response_size_bytes',
+                    'endpoint="{0}"'.format(endpoint)
+                ))
+            header('requests_total', 'counter', 'Handled requests.')
+            for (endpoint, status), count in sorted(self.statuses.items()):
+                lines.append(
+                    '{0}requests_total{{endpoint="{1}",status="{2}"}} {3}'
+                    .format(PREFIX, endpoint, status, count)
+                )
+            for name, values, kind, text in (
+                    ('data_loads_total', self.loads, 'counter',
+                     'Loads of presence data.'),
+                    ('data_load_seconds_total', self.load_seconds, 'counter',
+                     'Time spent loading presence data.'),
+                    ('data_rows_parsed_total', self.rows, 'counter',
+                     'Presence rows parsed while loading.')):
+                header(name, kind, text)
+                for load, value in sorted(values.items()):
+                    lines.append('{0}{1}{{kind="{2}"}} {3!r}'.format(
+                        PREFIX, name, load, value
+                    ))
+
+        if cache_stats is not None:
+            header('cache_events_total', 'counter',
+                   'Lookups and updates of cached function results.')
+            for event, count in sorted(cache_stats.items()):
+                lines.append('{0}cache_events_total{{event="{1}"}} {2}'.format(
+                    PREFIX, event, count
+                ))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+registry = Metrics()  # pylint: disable=invalid-name
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork multi-process server sharing data loaded by the master process.
+
+The master loads and indexes presence data once, then forks workers which
+share it copy-on-write. Columns of PresenceStore are plain arrays, so their
+memory is not touched by reference counting and stays shared.
+
+Workers never reload data on their own. The master checks every
+`check_interval` seconds whether the data file changed and then, or on
+SIGHUP, reloads data and replaces all workers.
+
+Signals handled by the master:
+ - SIGHUP reloads data and replaces all workers,
+ - SIGTERM and SIGINT stop the workers and the master.
+"""
+import errno
+import logging
+import os
+import signal
+
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from presence_analyzer import utils
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def load_data():
+    """
+    Loads presence and users data into caches inherited by workers.
+    Cached data does not expire, only the master replaces it.
+    """
+    utils.get_data()
+    utils.get_users_data()
+    utils.data_cache.freeze()
+
+
+def reload_data():
+    """
+    Drops cached data and loads it again.
+    """
+    utils.data_cache.clear()
+    load_data()
+
+
+def data_changed():
+    """
+    Checks whether presence data file changed since it was loaded.
+    """
+    loader = utils.get_loader()
+    return loader.data is None or loader.stat() != loader.identity
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Request handler logging through logging module.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug('%s %s', self.address_string(), format % args)
+
+
+class WorkerServer(WSGIServer):
+    """
+    WSGI server counting handled requests.
+    """
+    timeout = 1
+    served = 0
+
+    def finish_request(self, request, client_address):
+        self.served += 1
+        WSGIServer.finish_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    """
+    Master process keeping `workers` children serving the application.
+    Worker exits after `max_requests` requests (0 means never) and gets
+    replaced by a fresh fork of the master. Every `check_interval` seconds
+    (0 means never) the master reloads data when `changed` returns True.
+    """
+
+    def __init__(self, app, host, port, workers=4, max_requests=0,
+                 check_interval=15, preload=load_data, reload=reload_data,
+                 changed=data_changed):
+        self.app = app
+        self.address = (host, port)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.preload = preload
+        self.reload = reload
+        self.check_interval = check_interval
+        self.changed = changed
+        self.server = None
+        self.children = set()
+        self.alive = True
+        self.reloading = False
+        self.checking = False
+
+    def bind(self):
+        """
+        Opens listening socket shared by all workers.
+        """
+        self.server = WorkerServer(self.address, RequestHandler)
+        self.server.set_app(self.app)
+        self.address = self.server.server_address
+        log.info('Listening on %s:%s', *self.address)
+
+    def run(self):
+        """
+        Loads data, forks workers and replaces the ones which exited.
+        """
+        if self.server is None:
+            self.bind()
+        self.preload()
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGALRM, self.handle_check)
+        signal.alarm(self.check_interval)
+
+        while self.alive:
+            if self.checking:
+                self.checking = False
+                self.reloading = self.reloading or self.changed()
+                signal.alarm(self.check_interval)
+            if self.reloading:
+                self.reloading = False
+                log.info('Reloading data')
+                self.reload()
+                self.kill_workers()
+            while len(self.children) < self.workers and self.alive:
+                self.spawn_worker()
+            self.wait_worker()
+
+        signal.alarm(0)
+        self.kill_workers()
+        while self.children:
+            self.wait_worker()
+        self.server.server_close()
+
+    def spawn_worker(self):
+        """
+        Forks worker process.
+        """
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        try:
+            self.work()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Worker %s failed', os.getpid())
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+
+    def work(self):
+        """
+        Serves requests until stopped or recycled.
+        """
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        while self.alive:
+            if self.max_requests and self.server.served >= self.max_requests:
+                log.debug('Recycling worker %s', os.getpid())
+                break
+            self.server.handle_request()
+
+    def wait_worker(self):
+        """
+        Waits for any worker to exit.
+        """
+        try:
+            pid, _ = os.wait()
+        except OSError as error:
+            if error.errno == errno.ECHILD:
+                self.children.clear()
+            elif error.errno != errno.EINTR:
+                raise
+            return
+        self.children.discard(pid)
+
+    def kill_workers(self):
+        """
+        Asks workers to finish current request and exit.
+        """
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+
+    def handle_reload(self, *_):
+        """
+        SIGHUP handler.
+        """
+        self.reloading = True
+
+    def handle_check(self, *_):
+        """
+        SIGALRM handler.
+        """
+        self.checking = True
+
+    def handle_stop(self, *_):
+        """
+        SIGTERM handler.
+        """
+        self.alive = False
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Background thread keeping presence and users data up to date.
+
+Files are polled every `interval` seconds and changed data is loaded and
+indexed by the thread, then swapped into caches read by the views, so
+requests never wait for a parse.
+"""
+import logging
+
+from threading import Event, Lock, Thread
+
+from presence_analyzer import utils
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+lock = Lock()  # pylint: disable=invalid-name
+refreshers = []  # pylint: disable=invalid-name
+
+
+class Refresher(Thread):
+    """
+    Daemon thread calling `refresh` every `interval` seconds, the first
+    time at once unless `wait` is set.
+    """
+
+    def __init__(self, interval, refresh=utils.refresh_data, wait=True):
+        Thread.__init__(self, name='presence-refresher')
+        self.daemon = True
+        self.interval = interval
+        self.refresh = refresh
+        self.wait = wait
+        self.stopped = Event()
+
+    def run(self):
+        """
+        Refreshes data until stopped.
+        """
+        delay = self.interval if self.wait else 0
+        while not self.stopped.wait(delay):
+            delay = self.interval
+            try:
+                if self.refresh():
+                    log.info('Presence data refreshed')
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Cannot refresh data')
+
+    def stop(self):
+        """
+        Asks the thread to exit and waits for it.
+        """
+        self.stopped.set()
+        self.join()
+
+
+def start_refresher(interval, load=True):
+    """
+    Starts refreshing data in background, once per process.
+    :param float interval: seconds between checks of files
+    :param boolean load: load data before returning, otherwise the thread
+        loads it at once and early requests wait for that load
+    :return Refresher:
+    """
+    with lock:
+        if refreshers and refreshers[0].is_alive():
+            return refreshers[0]
+        if load:
+            utils.refresh_data()
+        refresher = Refresher(interval, wait=load)
+        refresher.start()
+        refreshers[:] = [refresher]
+        utils.refreshing = True
+        return refresher
+
+
+def stop_refresher():
+    """
+    Stops background refreshing, requests load changed data again.
+    """
+    with lock:
+        for refresher in refreshers:
+            refresher.stop()
+        del refreshers[:]
+        utils.refreshing = False
+        utils.data_cache.clear()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Serialized results of per-user views persisted across restarts.
+
+Results are kept in SQLite database keyed by view, its arguments and
+date range, together with version of presence data they were computed
+from. Entries are read one by one when requested and entries of other
+data versions are never served, they are deleted once data changes.
+"""
+import logging
+import sqlite3
+
+from presence_analyzer.sqlstore import connect
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# version of stored results, entries of other versions are dropped
+FORMAT = 1
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS results ('
+    ' key TEXT PRIMARY KEY,'
+    ' version TEXT NOT NULL,'
+    ' body BLOB NOT NULL'
+    ') WITHOUT ROWID',
+)
+
+
+class ResultStore(object):
+    """
+    Serialized results in SQLite database.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.checked = False
+        self.version = None
+
+    def connection(self):
+        """
+        Returns connection of current thread, dropping results of other
+        format once per store.
+        """
+        connection = connect(self.database, SCHEMA)
+        if not self.checked:
+            stored = connection.execute('PRAGMA user_version').fetchone()[0]
+            if stored != FORMAT:
+                log.info('Dropping results of format %s', stored)
+                connection.execute('DELETE FROM results')
+                connection.execute('PRAGMA user_version = {0:d}'.format(
+                    FORMAT
+                ))
+                connection.commit()
+            self.checked = True
+        return connection
+
+    def get(self, version, key):
+        """
+        Returns result stored for given data version or None.
+        :param string version: data version
+        :param string key:
+        :return string:
+        """
+        row = self.connection().execute(
+            'SELECT version, body FROM results WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or row[0] != version:
+            return None
+        return str(row[1])
+
+    def put(self, version, key, body):
+        """
+        Stores result computed from given data version, results of other
+        versions are deleted when version changes.
+        :param string version:
+        :param string key:
+        :param string body:
+        """
+        connection = self.connection()
+        try:
+            if version != self.version:
+                deleted = connection.execute(
+                    'DELETE FROM results WHERE version != ?', (version,)
+                ).rowcount
+                log.debug('Deleted %d results of old data', deleted)
+            connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (key, version, sqlite3.Binary(body))
+            )
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        self.version = version
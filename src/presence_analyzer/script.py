@@ -6,9 +6,6 @@ import os
 import sys
 from functools import partial
 
-import paste.script.command
-import werkzeug.script
-
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
@@ -24,12 +21,29 @@ for i in range(2 + __name__.count('.')):
 abspath = partial(os.path.join, _buildout_path)
 del _buildout_path
 
+PREFORK_PID = abspath('var', 'log', '.prefork.pid')
+
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, refresh=True,
+             warm_up=None):
+    # views, and the modules they use, are imported here and data is loaded
+    # by the first request unless WARM_UP is set or warm_up is given
+    from presence_analyzer import create_app
+    app = create_app()
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    from presence_analyzer.utils import check_config
+    check_config()
+    if warm_up is None:
+        warm_up = app.config.get('WARM_UP', False)
+    # DATA_REFRESH seconds between background checks of data files
+    if refresh and app.config.get('DATA_REFRESH'):
+        from presence_analyzer.refresher import start_refresher
+        start_refresher(app.config['DATA_REFRESH'], load=warm_up)
+    if warm_up:
+        from presence_analyzer.utils import warm_up as load_data
+        load_data()
     return app
 
 
@@ -44,18 +58,106 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    # data is loaded when first used in the shell
+    app = make_app(refresh=False, warm_up=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
 
 
+def _prefork(config, debug=False, dry_run=False):
+    """Serve the application with pre-forked worker processes."""
+    from ConfigParser import ConfigParser
+    from presence_analyzer.prefork import PreforkServer
+
+    parser = ConfigParser({'check_interval': '15'})
+    parser.read(abspath(config))
+    options = dict(parser.items('prefork'))
+    print 'prefork {0} workers on {1}:{2}'.format(
+        options['workers'], options['host'], options['port'])
+    if dry_run:
+        return
+    pid_file = PREFORK_PID
+    with open(pid_file, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        server = PreforkServer(
+            make_app(config=DEBUG_CFG if debug else DEPLOY_CFG, debug=debug,
+                     refresh=False),
+            options['host'],
+            int(options['port']),
+            workers=int(options['workers']),
+            max_requests=int(options['max_requests']),
+            check_interval=int(options['check_interval']),
+        )
+        server.run()
+    finally:
+        os.unlink(pid_file)
+
+
+def _prefork_pid():
+    """Pid of running pre-fork server or None."""
+    import errno
+    try:
+        with open(PREFORK_PID) as f:
+            pid = int(f.read())
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        os.unlink(PREFORK_PID)
+        return None
+    return pid
+
+
+def _reload(dry_run=False):
+    """Reload data in all workers of the pre-fork server."""
+    import signal
+    pid = _prefork_pid()
+    if pid is None:
+        print 'prefork server is not running'
+        return
+    print 'kill -HUP {0}'.format(pid)
+    if dry_run:
+        return
+    os.kill(pid, signal.SIGHUP)
+
+
+def _prefork_control(action, pid, config, debug=False, dry_run=False):
+    """Stop, restart or show status of the running pre-fork server."""
+    import signal
+    import time
+    if action == 'status':
+        print 'prefork server is running (PID: {0})'.format(pid)
+        return
+    print 'kill -TERM {0}'.format(pid)
+    if dry_run:
+        return
+    os.kill(pid, signal.SIGTERM)
+    while _prefork_pid() is not None:
+        time.sleep(0.1)
+    if action == 'restart':
+        _prefork(config, debug=debug)
+
+
 def _serve(action, debug=False, dry_run=False):
     """Build paster command from 'action' and 'debug' flag."""
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
+    if action == 'prefork':
+        return _prefork(config, debug=debug, dry_run=dry_run)
+    if action == 'reload':
+        return _reload(dry_run=dry_run)
+    if action in ('stop', 'restart', 'status'):
+        pid = _prefork_pid()
+        if pid is not None:
+            return _prefork_control(
+                action, pid, config, debug=debug, dry_run=dry_run)
     argv = ['bin/paster', 'serve', config]
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
@@ -75,14 +177,16 @@ def _serve(action, debug=False, dry_run=False):
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
+    import paste.script.command
     paste.script.command.run()
 
 
 # bin/flask-ctl ...
 def run():
+    import werkzeug.script
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
+    # bin/flask-ctl serve [fg|start|stop|restart|status|prefork|reload]
     def action_serve(action=('a', 'start'), dry_run=False):
         """Serve the application.
 
@@ -90,8 +194,13 @@ def run():
         configuration file for the server and application.
 
         Options:
-         - 'action' is one of [fg|start|stop|restart|status]
+         - 'action' is one of [fg|start|stop|restart|status|prefork|reload]
          - '--dry-run' print the paster command and exit
+
+        'prefork' loads data once and forks workers configured in the
+        [prefork] section, 'reload' makes them reload data. The pre-fork
+        server runs in the foreground; 'stop' and 'status' control it
+        when it is running and 'restart' starts it again in the foreground.
         """
         _serve(action, debug=False, dry_run=dry_run)
 
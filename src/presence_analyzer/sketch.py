@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of times of day and presence intervals.
+"""
+from array import array
+from collections import defaultdict
+
+
+class QuantileSketch(object):
+    """
+    Counts of values in bins `resolution` seconds wide.
+
+    Values are seconds within a day, so a sketch never has more than
+    86400 / resolution bins however many values it counts, only bins
+    with values are stored. Quantiles are exact to half of the resolution
+    and sketches of disjoint values merge by adding counts.
+    """
+    resolution = 60
+
+    def __init__(self, bins=None, counts=None):
+        self.bins = array('i') if bins is None else bins
+        self.counts = array('i') if counts is None else counts
+        self.total = sum(self.counts)
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Builds sketch of given values.
+        :param iterable values:
+        :return QuantileSketch:
+        """
+        counts = defaultdict(int)
+        for value in values:
+            counts[value // cls.resolution] += 1
+        return cls.from_counts(counts)
+
+    @classmethod
+    def from_counts(cls, counts):
+        """
+        Builds sketch from mapping of bin to count.
+        :param dict counts:
+        :return QuantileSketch:
+        """
+        bins = sorted(counts)
+        return cls(array('i', bins), array('i', [counts[i] for i in bins]))
+
+    def __len__(self):
+        return self.total
+
+    def __eq__(self, other):
+        return self.bins == other.bins and self.counts == other.counts
+
+    def __ne__(self, other):
+        return not self == other
+
+    def merge(self, other):
+        """
+        Returns sketch of values of both sketches.
+        :param QuantileSketch other:
+        :return QuantileSketch:
+        """
+        counts = defaultdict(int)
+        for sketch in (self, other):
+            for position, count in zip(sketch.bins, sketch.counts):
+                counts[position] += count
+        return self.from_counts(counts)
+
+    def quantile(self, fraction):
+        """
+        Nearest-rank quantile, middle of the bin holding it.
+        :param float fraction: between 0 and 1
+        :return integer: None when sketch is empty
+        """
+        if not self.total:
+            return None
+        rank = max(int(-(-fraction * self.total // 1)), 1)
+        seen = 0
+        for position, count in zip(self.bins, self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        return position * self.resolution + self.resolution // 2
+
+
+def build_sketches(rows):
+    """
+    QuantileSketch of intervals, starts and ends of every weekday.
+    :param iterable rows: (weekday, interval, start, end) tuples
+    :return tuple: seven (interval, start, end) sketch triples
+    """
+    resolution = QuantileSketch.resolution
+    counts = [[defaultdict(int) for _ in xrange(3)] for _ in xrange(7)]
+    for row in rows:
+        sketches = counts[row[0]]
+        for field in xrange(3):
+            sketches[field][row[field + 1] // resolution] += 1
+    return tuple(
+        tuple(QuantileSketch.from_counts(bins) for bins in sketches)
+        for sketches in counts
+    )
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Memory mapped binary snapshots of parsed presence data.
+
+Layout of version 2 file, all numbers are little endian:
+ - header with source file identity and parser state,
+ - user table, one record per user with its row range and WeekdayStats,
+ - user ids, days, starts and ends columns of 32-bit integers,
+ - WeekdayOrder days column of 32-bit integers and its running sums of
+   intervals, starts and ends as 64-bit floats.
+"""
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from array import array
+
+from presence_analyzer.store import (
+    PresenceStore,
+    WeekdayOrder,
+    WeekdayStats
+)
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PASN'
+VERSION = 2
+
+# magic, version, source device, inode, size, mtime, parsed offset,
+# next line number, rows, users, guard length and guard bytes
+HEADER = struct.Struct('<4sH2xQQQdQQQQH64s6x')
+# user id, first row, last row + 1 and count/total/start/end per weekday
+USER = struct.Struct('<iQQ28q')
+# items of columns by array typecode
+ITEMS = {
+    PresenceStore.typecode: struct.Struct('<i'),
+    PresenceStore.sum_typecode: struct.Struct('<d'),
+}
+# typecodes of user ids, days, starts, ends and WeekdayOrder columns
+COLUMNS = (PresenceStore.typecode,) * 5 + (PresenceStore.sum_typecode,) * 3
+
+assert all(
+    array(typecode).itemsize == item.size
+    for typecode, item in ITEMS.iteritems()
+)
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot file is not a valid snapshot of supported version.
+    """
+
+
+class MappedColumn(object):
+    """
+    Read-only column of numbers of given array typecode stored in memory
+    map. Slices are copied into arrays, so callers get the same type as
+    from in-memory PresenceStore.
+    """
+
+    def __init__(self, buf, offset, length, typecode=PresenceStore.typecode):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.typecode = typecode
+        self.item = ITEMS[typecode]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self.length)
+            size = self.item.size
+            column = array(self.typecode)
+            if stop > start:
+                column.fromstring(
+                    self.buf[self.offset + start * size:
+                             self.offset + stop * size]
+                )
+            if sys.byteorder != 'little':
+                column.byteswap()
+            return column
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('column index out of range')
+        return self.item.unpack_from(
+            self.buf, self.offset + index * self.item.size
+        )[0]
+
+    def __iter__(self):
+        step = 1 << 16
+        for start in xrange(0, self.length, step):
+            for value in self[start:start + step]:
+                yield value
+
+
+def file_mode():
+    """
+    Mode of files created by open() under current umask, temporary files
+    get 0600 and are given this mode before they replace the file.
+    :return integer:
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+
+def write_snapshot(path, data, state):
+    """
+    Writes PresenceStore and loader state to snapshot file.
+    File is written aside and renamed, so readers never see partial file.
+    :param string path:
+    :param PresenceStore data:
+    :param dict state: identity, offset, line and guard of the loader
+    """
+    users = data.users()
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            stream.write(HEADER.pack(
+                MAGIC, VERSION,
+                state['identity'][0], state['identity'][1],
+                state['identity'][2], state['identity'][3],
+                state['offset'], state['line'],
+                len(data), len(users),
+                len(state['guard']), state['guard'],
+            ))
+            for user_id in users:
+                head, tail = data.offsets[user_id]
+                totals = []
+                for stats in data.weekday_stats(user_id):
+                    totals.extend(stats)
+                stream.write(USER.pack(user_id, head, tail, *totals))
+            columns = (data.user_ids, data.days, data.starts, data.ends)
+            for column in columns + data.order:
+                column = column[:]
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                column.tofile(stream)
+        os.chmod(temp_path, file_mode())
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def read_snapshot(path):
+    """
+    Maps snapshot file into PresenceStore backed by MappedColumn columns.
+    :param string path:
+    :return tuple: PresenceStore and loader state
+    """
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size < HEADER.size:
+            raise SnapshotError('{0} is too short'.format(path))
+        buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header = HEADER.unpack_from(buf)
+    if header[0] != MAGIC or header[1] != VERSION:
+        raise SnapshotError('{0} has unsupported format'.format(path))
+    rows, users = header[8], header[9]
+    columns_offset = HEADER.size + users * USER.size
+    rows_size = sum(ITEMS[typecode].size for typecode in COLUMNS) * rows
+    if len(buf) != columns_offset + rows_size:
+        raise SnapshotError('{0} is truncated'.format(path))
+
+    offsets, weekdays = {}, {}
+    for position in xrange(users):
+        record = USER.unpack_from(buf, HEADER.size + position * USER.size)
+        offsets[record[0]] = (record[1], record[2])
+        weekdays[record[0]] = tuple(
+            WeekdayStats(*record[3 + day * 4:7 + day * 4])
+            for day in xrange(7)
+        )
+
+    columns = []
+    for typecode in COLUMNS:
+        columns.append(MappedColumn(buf, columns_offset, rows, typecode))
+        columns_offset += ITEMS[typecode].size * rows
+    data = PresenceStore(
+        *columns[:4],
+        offsets=offsets,
+        weekdays=weekdays,
+        order=WeekdayOrder(*columns[4:])
+    )
+    state = {
+        'identity': header[2:6],
+        'offset': header[6],
+        'line': header[7],
+        'guard': header[11][:header[10]],
+    }
+    return data, state
+
+
+def compile_snapshot():
+    """
+    Compiles DATA_CSV into DATA_SNAPSHOT file.
+    """
+    from presence_analyzer.ingest import PresenceLoader
+    from presence_analyzer.script import make_app
+
+    app = make_app(refresh=False)
+    loader = PresenceLoader(
+        app.config['DATA_CSV'], app.config['DATA_SNAPSHOT']
+    )
+    data = loader.build_snapshot()
+    print 'Compiled {0} rows into {1}'.format(
+        len(data), app.config['DATA_SNAPSHOT']
+    )
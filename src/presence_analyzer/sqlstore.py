@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage of presence data for datasets too large to keep in memory
+of every process.
+
+Rows are ingested incrementally into a table keyed by (user_id, day) and
+weekday aggregates are computed by SQL queries using that index.
+"""
+import logging
+import os
+import sqlite3
+import time
+
+from array import array
+from itertools import izip
+from threading import local
+
+from presence_analyzer.ingest import PresenceLoader, PresenceParser
+from presence_analyzer.metrics import registry
+from presence_analyzer.sketch import build_sketches
+from presence_analyzer.store import (
+    PresenceSlice,
+    PresenceStore,
+    WeekdayStats,
+    weekday
+)
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS presence ('
+    ' user_id INTEGER NOT NULL,'
+    ' day INTEGER NOT NULL,'
+    ' weekday INTEGER NOT NULL,'
+    ' start_time INTEGER NOT NULL,'
+    ' end_time INTEGER NOT NULL,'
+    ' PRIMARY KEY (user_id, day)'
+    ') WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS source ('
+    ' id INTEGER PRIMARY KEY CHECK (id = 0),'
+    ' device INTEGER, inode INTEGER, size INTEGER, mtime REAL,'
+    ' offset INTEGER, line INTEGER, guard BLOB'
+    ')',
+)
+STATS_COLUMNS = (
+    'weekday, COUNT(*), SUM(end_time - start_time),'
+    ' SUM(start_time), SUM(end_time)'
+)
+# day ordinals of 0001-01-01 and 9999-12-31
+FIRST_DAY, LAST_DAY = 1, 3652059
+
+connections = local()  # pylint: disable=invalid-name
+
+
+def connect(database, schema=SCHEMA):
+    """
+    Connection to database kept for the current thread and process,
+    statements of `schema` are executed when it is opened.
+    :param string database:
+    :param tuple schema:
+    :return sqlite3.Connection:
+    """
+    if getattr(connections, 'pid', None) != os.getpid():
+        # connections inherited by forked process must not be used
+        connections.pid = os.getpid()
+        connections.opened = {}
+    connection = connections.opened.get(database)
+    if connection is None:
+        connection = sqlite3.connect(database)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in schema:
+            connection.execute(statement)
+        connection.commit()
+        connections.opened[database] = connection
+    return connection
+
+
+def weekday_stats(rows):
+    """
+    WeekdayStats of every weekday from (weekday, count, total, start, end)
+    rows of grouped query.
+    :param iterable rows:
+    :return tuple:
+    """
+    result = [WeekdayStats(0, 0, 0, 0)] * 7
+    for row in rows:
+        result[row[0]] = WeekdayStats(*row[1:])
+    return tuple(result)
+
+
+class SQLiteStore(object):
+    """
+    Presence data in SQLite database with the query interface of
+    PresenceStore used by views.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.version = None
+        self._users = None
+
+    def connection(self):
+        """
+        Returns connection of current thread.
+        """
+        return connect(self.database)
+
+    def __len__(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM presence'
+        ).fetchone()[0]
+
+    def __contains__(self, user_id):
+        return user_id in self.user_set()
+
+    def __iter__(self):
+        return iter(self.users())
+
+    def user_set(self):
+        """
+        Returns set of user ids, read once per store.
+        """
+        if self._users is None:
+            self._users = frozenset(
+                row[0] for row in self.connection().execute(
+                    'SELECT DISTINCT user_id FROM presence'
+                )
+            )
+        return self._users
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.user_set())
+
+    def day_range(self, user_id):
+        """
+        Returns ordinals of first and last day of given user.
+        """
+        return self.connection().execute(
+            'SELECT MIN(day), MAX(day) FROM presence WHERE user_id = ?',
+            (user_id,)
+        ).fetchone()
+
+    def slice(self, user_id):
+        """
+        Returns days, starts and ends of given user.
+        """
+        result = PresenceSlice(*(
+            array(PresenceStore.typecode) for _ in xrange(3)
+        ))
+        for row in self.connection().execute(
+                'SELECT day, start_time, end_time FROM presence'
+                ' WHERE user_id = ? ORDER BY day', (user_id,)):
+            for column, value in zip(result, row):
+                column.append(value)
+        return result
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns WeekdayStats of given user for every weekday, optionally
+        of days in inclusive range of `first` and `last` day ordinals.
+        """
+        return weekday_stats(self.connection().execute(
+            'SELECT {0} FROM presence'
+            ' WHERE user_id = ? AND day BETWEEN ? AND ?'
+            ' GROUP BY weekday'.format(STATS_COLUMNS),
+            (user_id, first or FIRST_DAY, last or LAST_DAY)
+        ))
+
+    def quantile_sketches(self, user_id, first=None, last=None):
+        """
+        Returns (interval, start, end) QuantileSketch of given user for
+        every weekday, optionally of days in inclusive range of `first`
+        and `last` day ordinals.
+        """
+        return build_sketches(self.connection().execute(
+            'SELECT weekday, end_time - start_time, start_time, end_time'
+            ' FROM presence WHERE user_id = ? AND day BETWEEN ? AND ?',
+            (user_id, first or FIRST_DAY, last or LAST_DAY)
+        ))
+
+    def total_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayStats summed over given users, all users by default.
+        """
+        query = 'SELECT {0} FROM presence WHERE day BETWEEN ? AND ?'.format(
+            STATS_COLUMNS
+        )
+        arguments = [first or FIRST_DAY, last or LAST_DAY]
+        if user_ids is not None:
+            user_ids = list(user_ids)
+            query += ' AND user_id IN ({0})'.format(
+                ', '.join('?' * len(user_ids))
+            )
+            arguments.extend(user_ids)
+        return weekday_stats(self.connection().execute(
+            query + ' GROUP BY weekday', arguments
+        ))
+
+
+class SQLiteLoader(PresenceLoader):
+    """
+    Keeps SQLite database up to date with append-only CSV file.
+
+    Parsing state is stored in the database, so after restart only lines
+    appended since the last ingest are parsed. Every ingest is a single
+    transaction, readers see either old or new rows.
+    """
+
+    def __init__(self, path, database):
+        PresenceLoader.__init__(self, path)
+        self.database = database
+
+    def load(self):
+        """
+        Returns SQLiteStore of current file content.
+        """
+        with self.lock:
+            identity = self.stat()
+            if self.data is None:
+                self.resume()
+            if self.data is None or identity != self.identity:
+                self.parse(identity)
+            return self.data
+
+    def resume(self):
+        """
+        Continues from parsing state stored in the database.
+        """
+        row = connect(self.database).execute(
+            'SELECT device, inode, size, mtime, offset, line, guard'
+            ' FROM source'
+        ).fetchone()
+        if row is not None:
+            self.set_state(SQLiteStore(self.database), {
+                'identity': tuple(row[:4]),
+                'offset': row[4],
+                'line': row[5],
+                'guard': str(row[6]),
+            })
+
+    def parse(self, identity):
+        """
+        Inserts appended tail or whole file into the database.
+        """
+        started, rows = time.time(), [0]
+        connection = connect(self.database)
+
+        def insert(columns):
+            """
+            Inserts parsed rows, later rows override earlier ones.
+            """
+            connection.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?, ?)',
+                ((user_id, day, weekday(day), start, end)
+                 for user_id, day, start, end in izip(*columns))
+            )
+            rows[0] += len(columns[0])
+
+        try:
+            with open(self.path, 'rb') as stream:
+                appended = self.is_appended(stream, identity)
+                if appended:
+                    parser = PresenceParser(self.offset, self.line)
+                    stream.seek(self.offset)
+                else:
+                    parser = PresenceParser()
+                    stream.seek(0)
+                    connection.execute('DELETE FROM presence')
+                parser.parse_stream(stream, flush=insert)
+                self.read_guard(stream, parser.offset)
+            self.identity = identity
+            self.offset, self.line = parser.offset, parser.line
+            connection.execute(
+                'INSERT OR REPLACE INTO source'
+                ' VALUES (0, ?, ?, ?, ?, ?, ?, ?)',
+                tuple(identity) + (
+                    self.offset, self.line, sqlite3.Binary(self.guard)
+                )
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            self.data = None
+            raise
+
+        log.debug('Inserted %d rows of %s', rows[0], self.path)
+        registry.observe_load(
+            'sqlite-append' if appended else 'sqlite-full',
+            time.time() - started,
+            rows[0],
+        )
+        self.set_data(SQLiteStore(self.database))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Startup time profile of the application: time of importing it, creating
+it by script.make_app and warming it up, with import timings per module.
+
+The profile is taken in a fresh interpreter which loads this file as a
+standalone module, so imports of the package and its dependencies are
+timed too.
+"""
+import __builtin__
+import json
+import os
+import sys
+import time
+
+# run by the fresh interpreter with path of this file, config and warm-up
+BOOTSTRAP = (
+    'import imp, json, sys\n'
+    'startup = imp.load_source("presence_analyzer_startup", sys.argv[1])\n'
+    'result = startup.profile(sys.argv[2], sys.argv[3] == "1")\n'
+    'sys.stdout.write("\\n" + json.dumps(result) + "\\n")\n'
+)
+
+
+class ImportProfiler(object):
+    """
+    Times imports loading new modules while active.
+
+    Every import loading modules is recorded under the deepest module it
+    loaded, with its cumulative time and self time excluding nested
+    imports.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.nested = []
+        self.original = None
+
+    def __enter__(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self.load
+        return self
+
+    def __exit__(self, *exc_info):
+        __builtin__.__import__ = self.original
+
+    def load(self, name, globals=None, locals=None, fromlist=None,
+             level=-1):  # pylint: disable=redefined-builtin
+        """
+        Replacement of __import__ timing it.
+        """
+        if not fromlist and sys.modules.get(name) is not None:
+            return self.original(name, globals, locals, fromlist, level)
+
+        before = set(sys.modules)
+        # time of nested imports and modules they loaded
+        self.nested.append([0.0, set()])
+        started = time.time()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - started
+            nested, inner = self.nested.pop()
+            loaded = set(sys.modules) - before
+            if self.nested:
+                self.nested[-1][0] += elapsed
+                self.nested[-1][1].update(loaded)
+            own = [
+                module for module in loaded - inner
+                if sys.modules.get(module) is not None
+            ]
+            if own:
+                self.timings[max(own, key=len)] = (elapsed - nested, elapsed)
+
+    def report(self):
+        """
+        Timings of imported modules, slowest first.
+        :return list: dicts with module, self_s and cumulative_s
+        """
+        return [
+            {'module': module, 'self_s': spent, 'cumulative_s': cumulative}
+            for module, (spent, cumulative) in sorted(
+                self.timings.iteritems(), key=lambda item: -item[1][1]
+            )
+        ]
+
+
+def profile(config, warm_up=False):
+    """
+    Imports, creates and optionally warms up the application, timing
+    every phase. Meant to run in a fresh interpreter, see measure.
+    :param string config: path of configuration, relative to buildout
+    :param boolean warm_up: whether data is loaded too
+    :return dict:
+    """
+    phases = []
+    profiler = ImportProfiler()
+    started = time.time()
+    with profiler:
+        from presence_analyzer.script import make_app
+        phases.append(('import', time.time() - started))
+        mark = time.time()
+        make_app(config=config, refresh=False, warm_up=False)
+        phases.append(('make_app', time.time() - mark))
+        if warm_up:
+            from presence_analyzer.utils import warm_up as load_data
+            mark = time.time()
+            load_data()
+            phases.append(('warm_up', time.time() - mark))
+    return {
+        'phases': phases,
+        'total_s': time.time() - started,
+        'imports': profiler.report(),
+    }
+
+
+def measure(config, warm_up=False):
+    """
+    Profiles startup in a fresh interpreter with the same module path.
+    :param string config:
+    :param boolean warm_up:
+    :return dict: result of profile and process_s, wall time of the process
+    """
+    import subprocess
+
+    source = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        path for path in sys.path if path
+    ))
+    started = time.time()
+    output = subprocess.check_output(
+        [sys.executable, '-c', BOOTSTRAP, source, config,
+         '1' if warm_up else '0'],
+        env=environment,
+    )
+    result = json.loads(output.rstrip().rsplit('\n', 1)[-1])
+    result['process_s'] = time.time() - started
+    return result
+
+
+def print_report(result, top=20, stream=sys.stdout):
+    """
+    Prints phases and the slowest imports.
+    :param dict result: result of measure
+    :param integer top: number of imports printed
+    :param file stream:
+    """
+    for name, seconds in result['phases']:
+        stream.write('{0:<48}{1:>10.3f}\n'.format(name, seconds))
+    stream.write('{0:<48}{1:>10.3f}\n'.format('total', result['total_s']))
+    stream.write('{0:<48}{1:>10.3f}\n\n'.format(
+        'process', result['process_s']
+    ))
+    stream.write('{0:<48}{1:>10}{2:>12}\n'.format(
+        'import', 'self', 'cumulative'
+    ))
+    for timing in result['imports'][:top]:
+        stream.write('{module:<48}{self_s:>10.3f}{cumulative_s:>12.3f}\n'
+                     .format(**timing))
+
+
+def run(argv=None):
+    """
+    Reports startup time of the application and import timings per module.
+    """
+    import argparse
+    from presence_analyzer.script import DEBUG_CFG, DEPLOY_CFG
+
+    parser = argparse.ArgumentParser(description=run.__doc__)
+    parser.add_argument('--config', help='deploy.cfg by default')
+    parser.add_argument('--debug', action='store_true',
+                        help='use debug.cfg')
+    parser.add_argument('--warm-up', action='store_true',
+                        help='load data after creating the application')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of slowest imports reported')
+    parser.add_argument('--budget', type=float,
+                        help='fail when the process takes more seconds')
+    parser.add_argument('--json', action='store_true',
+                        help='print measurements as JSON')
+    args = parser.parse_args(argv)
+
+    config = args.config or (DEBUG_CFG if args.debug else DEPLOY_CFG)
+    result = measure(config, args.warm_up)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    else:
+        print_report(result, args.top)
+    if args.budget is not None and result['process_s'] > args.budget:
+        sys.exit('Startup took {0:.3f}s, over budget of {1:.3f}s'.format(
+            result['process_s'], args.budget
+        ))
+    return result
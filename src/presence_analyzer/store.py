@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar storage of presence data.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import izip
+
+from presence_analyzer.sketch import build_sketches
+
+# Day ordinal 1 (0001-01-01) is a Monday, see datetime.date.fromordinal.
+WEEKDAY_OFFSET = 1
+
+# Ordinals are below 2 ** 22, so (user_id << 22) | day is a unique sort key.
+DAY_BITS = 22
+
+PresenceSlice = namedtuple('PresenceSlice', ['days', 'starts', 'ends'])
+
+# Aggregates of one weekday: number of entries, sum of intervals,
+# starts and ends in seconds.
+WeekdayStats = namedtuple('WeekdayStats', ['count', 'total', 'start', 'end'])
+
+# Rows of every user reordered by weekday and day, with running sums of
+# intervals, starts and ends restarting at each user and weekday.
+WeekdayOrder = namedtuple('WeekdayOrder', ['days', 'total', 'start', 'end'])
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+    """
+    return (day - WEEKDAY_OFFSET) % 7
+
+
+def index_rows(days, starts, ends, order):
+    """
+    Appends rows of one user to WeekdayOrder columns.
+    Returns WeekdayStats of the rows for every weekday.
+    """
+    positions = [[] for _ in xrange(7)]
+    for row, day in enumerate(days):
+        positions[weekday(day)].append(row)
+
+    result = []
+    for indexes in positions:
+        total = start = end = 0
+        for row in indexes:
+            total += ends[row] - starts[row]
+            start += starts[row]
+            end += ends[row]
+            order.days.append(days[row])
+            order.total.append(total)
+            order.start.append(start)
+            order.end.append(end)
+        result.append(WeekdayStats(len(indexes), total, start, end))
+    return tuple(result)
+
+
+class PresenceStore(object):
+    """
+    Presence entries kept in parallel typed arrays sorted by user and date.
+
+    Every row is described by user id, day ordinal and start/end time
+    in seconds since midnight. Rows of one user are contiguous and
+    `offsets` maps user id to the (head, tail) range of the user's rows and
+    `weekdays` to seven WeekdayStats of those rows, built once per load.
+    Within the same ranges `order` keeps rows sorted by weekday and day
+    with running sums, so stats of any date range are found by binary
+    search. Quantile sketches of a user are built on first use and kept
+    in `sketches`. `version` identifies the source the data was loaded from.
+    """
+    typecode = 'i'
+    sum_typecode = 'd'
+
+    def __init__(self, user_ids=None, days=None, starts=None, ends=None,
+                 offsets=None, weekdays=None, order=None):
+        """
+        Wraps already sorted and deduplicated columns.
+        User ranges are found in the rows unless `offsets` are given and
+        weekday index is built from the rows unless `weekdays` and `order`
+        are given.
+        """
+        self.version = None
+        self.user_ids = self.column() if user_ids is None else user_ids
+        self.days = self.column() if days is None else days
+        self.starts = self.column() if starts is None else starts
+        self.ends = self.column() if ends is None else ends
+        self.offsets = offsets
+        self.weekdays = weekdays
+        self.order = order
+        self.sketches = {}
+
+        if offsets is None:
+            self.offsets = {}
+            head, size = 0, len(self.user_ids)
+            for tail in xrange(1, size + 1):
+                if tail == size or self.user_ids[tail] != self.user_ids[head]:
+                    self.offsets[self.user_ids[head]] = (head, tail)
+                    head = tail
+
+        if weekdays is None or order is None:
+            self.weekdays, self.order = {}, self.weekday_order()
+            for user_id in self.users():
+                items = self.slice(user_id)
+                self.weekdays[user_id] = index_rows(
+                    items.days, items.starts, items.ends, self.order
+                )
+
+    @classmethod
+    def column(cls, typecode=None):
+        """
+        Returns empty column.
+        """
+        return array(typecode or cls.typecode)
+
+    @classmethod
+    def weekday_order(cls):
+        """
+        Returns empty WeekdayOrder columns.
+        """
+        return WeekdayOrder(
+            cls.column(),
+            cls.column(cls.sum_typecode),
+            cls.column(cls.sum_typecode),
+            cls.column(cls.sum_typecode),
+        )
+
+    @classmethod
+    def from_columns(cls, user_ids, days, starts, ends):
+        """
+        Builds store from columns in file order.
+        When user has more than one entry for a day the last one wins.
+        """
+        keys = [
+            (user_id << DAY_BITS) | day
+            for user_id, day in zip(user_ids, days)
+        ]
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+
+        result = [array(cls.typecode) for _ in xrange(4)]
+        for position, row in enumerate(order):
+            following = order[position + 1:position + 2]
+            if following and keys[following[0]] == keys[row]:
+                # duplicated user and date, the later row overrides this one
+                continue
+            result[0].append(user_ids[row])
+            result[1].append(days[row])
+            result[2].append(starts[row])
+            result[3].append(ends[row])
+        return cls(*result)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, day, start, end) tuples.
+        """
+        columns = [array(cls.typecode) for _ in xrange(4)]
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        return cls.from_columns(*columns)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.users())
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.offsets)
+
+    def day_range(self, user_id):
+        """
+        Returns ordinals of first and last day of given user.
+        """
+        head, tail = self.offsets[user_id]
+        return self.days[head], self.days[tail - 1]
+
+    def slice(self, user_id):
+        """
+        Returns days, starts and ends of given user.
+        """
+        head, tail = self.offsets[user_id]
+        return PresenceSlice(
+            self.days[head:tail],
+            self.starts[head:tail],
+            self.ends[head:tail],
+        )
+
+    def merge(self, other):
+        """
+        Returns new store with rows of both stores.
+        Rows of `other` override rows of this store for the same user and date.
+        Weekday index is copied for users present in one store only
+        and extended for users whose rows in `other` all follow their rows
+        in this store, only overlapping users are indexed again.
+        """
+        result = [self.column() for _ in xrange(4)]
+        weekdays, order = {}, self.weekday_order()
+        for user_id in sorted(set(self.offsets) | set(other.offsets)):
+            if user_id not in other.offsets or user_id not in self.offsets:
+                source = self if user_id in self.offsets else other
+                head, tail = source.offsets[user_id]
+                columns = (
+                    source.user_ids, source.days, source.starts, source.ends
+                )
+                for column, values in zip(result + list(order),
+                                          columns + source.order):
+                    column.extend(values[head:tail])
+                weekdays[user_id] = source.weekdays[user_id]
+                continue
+
+            if other.days[other.offsets[user_id][0]] > \
+                    self.days[self.offsets[user_id][1] - 1]:
+                weekdays[user_id] = self.append_rows(
+                    user_id, other, result, order
+                )
+                continue
+
+            rows = {}
+            for source in (self, other):
+                items = source.slice(user_id)
+                rows.update(zip(items.days, zip(*items)))
+            head = len(result[0])
+            for day in sorted(rows):
+                result[0].append(user_id)
+                for column, value in zip(result[1:], rows[day]):
+                    column.append(value)
+            weekdays[user_id] = index_rows(
+                result[1][head:], result[2][head:], result[3][head:], order
+            )
+        return self.__class__(*result, weekdays=weekdays, order=order)
+
+    def append_rows(self, user_id, other, result, order):
+        """
+        Appends rows of given user in this store followed by the user's
+        rows in `other`, which are all of later days, to `result` columns
+        and its weekday index to `order`.
+        Returns WeekdayStats of the joined rows.
+        """
+        stores = (self, other)
+        for store in stores:
+            head, tail = store.offsets[user_id]
+            columns = (store.user_ids, store.days, store.starts, store.ends)
+            for column, values in zip(result, columns):
+                column.extend(values[head:tail])
+
+        stats = []
+        heads = [store.offsets[user_id][0] for store in stores]
+        for day in xrange(7):
+            before = self.weekdays[user_id][day]
+            after = other.weekdays[user_id][day]
+            for position, store in enumerate(stores):
+                head = heads[position]
+                count = store.weekdays[user_id][day].count
+                tail = heads[position] = head + count
+                order.days.extend(store.order.days[head:tail])
+                for column, sums, base in zip(order[1:], store.order[1:],
+                                              before[1:]):
+                    # running sums of `other` continue from this store's
+                    column.extend(
+                        sums[head:tail] if store is self
+                        else (value + base for value in sums[head:tail])
+                    )
+            stats.append(WeekdayStats(*(
+                first + second for first, second in zip(before, after)
+            )))
+        return tuple(stats)
+
+    def aggregate(self, user_id):
+        """
+        Computes WeekdayStats of given user from the rows.
+        """
+        items = self.slice(user_id)
+        return index_rows(
+            items.days, items.starts, items.ends, self.weekday_order()
+        )
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns WeekdayStats of given user for every weekday.
+        With `first` or `last` day ordinal only days in that inclusive
+        range are counted, in O(log n) time per weekday.
+        """
+        stats = self.weekdays[user_id]
+        if first is None and last is None:
+            return stats
+
+        order, result = self.order, []
+        tail = self.offsets[user_id][0]
+        for entry in stats:
+            head, tail = tail, tail + entry.count
+            begin, end = head, tail
+            if first is not None:
+                begin = bisect_left(order.days, first, head, tail)
+            if last is not None:
+                end = bisect_right(order.days, last, begin, tail)
+            if begin >= end:
+                result.append(WeekdayStats(0, 0, 0, 0))
+                continue
+            result.append(WeekdayStats(end - begin, *(
+                int(sums[end - 1] - (sums[begin - 1] if begin > head else 0))
+                for sums in order[1:]
+            )))
+        return tuple(result)
+
+    def quantile_sketches(self, user_id, first=None, last=None):
+        """
+        Returns (interval, start, end) QuantileSketch of given user for
+        every weekday. Sketches of all days are built once per store,
+        `first` and `last` limit the range as in weekday_stats.
+        """
+        ranged = first is not None or last is not None
+        if not ranged and user_id in self.sketches:
+            return self.sketches[user_id]
+
+        items = self.slice(user_id)
+        result = build_sketches(
+            (weekday(day), end - start, start, end)
+            for day, start, end in izip(*items)
+            if (first is None or day >= first) and
+            (last is None or day <= last)
+        )
+        if not ranged:
+            self.sketches[user_id] = result
+        return result
+
+    def total_stats(self, user_ids=None, first=None, last=None):
+        """
+        Returns WeekdayStats summed over given users, all users by default.
+        Users without rows are skipped, `first` and `last` limit the range
+        as in weekday_stats.
+        """
+        if user_ids is None:
+            user_ids = self.offsets
+        totals = [[0] * len(WeekdayStats._fields) for _ in xrange(7)]
+        for user_id in user_ids:
+            if user_id not in self.offsets:
+                continue
+            for sums, entry in zip(totals,
+                                   self.weekday_stats(user_id, first, last)):
+                for field, value in enumerate(entry):
+                    sums[field] += value
+        return tuple(WeekdayStats(*sums) for sums in totals)
@@ -2,17 +2,34 @@
 """
 Presence analyzer unit tests.
 """
+import BaseHTTPServer
+import calendar
+import os
 import os.path
 import json
 import datetime
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zlib
 
 from flask import Response
-from presence_analyzer import main, utils, views
+from presence_analyzer import avatars, benchmark, ingest, main, metrics, prefork, refresher, results, script, sketch, snapshot, sqlstore, startup, store, utils, views
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
+TEST_USERS_XML = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
+)
+TEST_TEAMS_JSON = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_teams.json'
+)
 
 
 # pylint: disable=maybe-no-member, too-many-public-methods, invalid-name, line-too-long
@@ -25,7 +42,11 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         """
         Before each test, set up a environment.
         """
-        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_DATA': TEST_USERS_XML,
+            'TEAMS_DATA': TEST_TEAMS_JSON,
+        })
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -68,7 +89,24 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
-        self.assertDictEqual(data[0], {u'user_id': 10, u'name': u'User 10'})
+        self.assertDictEqual(data[0], {
+            u'user_id': 10,
+            u'name': u'User 10',
+            u'avatar': u'https://intranet.example.com:443/api/images/users/10',
+        })
+
+    def test_api_users_view__should_call_twice__result_is_reused_body(self):
+        """
+        Test users listing body is computed once for unchanged data.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        first = self.client.get('/api/v1/users', headers=headers)
+        second = self.client.get('/api/v1/users', headers=headers)
+        self.assertEqual(first.data, second.data)
+        self.assertIs(
+            utils.users_listing(utils.get_data(), utils.get_users_data()),
+            utils.users_listing(utils.get_data(), utils.get_users_data())
+        )
 
     def test_api_users_view__should_call_not_xhr_request__result_is_501_http_exception(self):
         """
@@ -166,35 +204,253 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         }
         self.assertDictEqual(expected, result)
 
+    def test_presence_weekday_view__should_get_matching_etag__result_is_304_not_modified(self):
+        """
+        Test conditional request.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+
+        headers['If-None-Match'] = etag
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
 
-class SimpleCacheDummy():
-    """
-    Dummy cache object it is created to help with testing cache method.
-    """
-    def __init__(self):
-        self._cache = {}
-        self.timeout = None
+        resp = self.client.get('/api/v1/presence_weekday/11', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get('/api/v1/presence_weekday/10', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 501)
+
+    def test_org_view__should_get_statistic__result_is_statistic_of_all_users(self):
+        """
+        Test organization-wide statistic.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/org/presence_weekday', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        users = [json.loads(self.client.get('/api/v1/presence_weekday/{0}'.format(user_id), headers=headers).data)[1:] for user_id in (10, 11)]
+        self.assertListEqual(data, [[day, first + second] for (day, first), (_, second) in zip(*users)])
+
+        resp = self.client.get('/api/v1/org/mean_time_weekday?team=backend&to=2013-09-11', headers=headers)
+        single = self.client.get('/api/v1/mean_time_weekday/10?to=2013-09-11', headers=headers)
+        self.assertListEqual(json.loads(resp.data), json.loads(single.data))
+
+        resp = self.client.get('/api/v1/org/presence_start_end?team=nobody', headers=headers)
+        self.assertDictEqual(json.loads(resp.data), {})
+
+    def test_org_view__should_get_unknown_team_or_statistic__result_is_404_http_exception(self):
+        """
+        Test organization statistic of unknown team or statistic.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/org/presence_weekday?team=frontend', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get('/api/v1/org/median', headers=headers)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_teams_view__should_get_teams__result_is_teams_listing(self):
+        """
+        Test teams listing.
+        """
+        resp = self.client.get('/api/v1/teams', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(json.loads(resp.data), [
+            {u'team': u'backend', u'users': [10]},
+            {u'team': u'nobody', u'users': [99]},
+        ])
 
-    def set(self, key, value, timeout=None):
+    def test_export_view__should_get_csv__result_is_streamed_statistics_of_users(self):
         """
-        Sets key and value parameter, time out is here just to keep interface consistency.
-        :param mixed key:
-        :param mixed value:
-        :param integer timeout:
+        Test CSV export.
         """
-        self._cache[key] = value
-        self.timeout = timeout
+        resp = self.client.get('/api/v1/export.csv?to=2013-09-12')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/csv; charset=utf-8')
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], 'user_id,weekday,count,total,mean,start,end')
+        self.assertEqual(lines[1], '10,Tue,1,30047,30047.0,34745.0,64792.0')
+        self.assertEqual(len(lines), 8)
+
+        resp = self.client.get('/api/v1/export.ndjson?to=2013-09-12')
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        records = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(records), 7)
+        self.assertDictEqual(records[0], {
+            u'user_id': 10, u'weekday': u'Tue', u'count': 1, u'total': 30047,
+            u'mean': 30047.0, u'start': 34745.0, u'end': 64792.0,
+        })
+
+    def test_export_view__should_get_unknown_format__result_is_404_http_exception(self):
+        """
+        Test export in unknown format.
+        """
+        resp = self.client.get('/api/v1/export.xls')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_metrics_view__should_get_requests__result_is_prometheus_metrics(self):
+        """
+        Test metrics endpoint.
+        """
+        registry_temp = main.registry
+        main.registry = views.registry = metrics.Metrics()
+        try:
+            self.client.get('/api/v1/presence_weekday/10', headers={'X-Requested-With': 'XMLHttpRequest'})
+            self.client.get('/api/v1/presence_weekday/10')
+            self.client.get('/api/v1/batch')
+            resp = self.client.get('/metrics')
+        finally:
+            main.registry = views.registry = registry_temp
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/plain; version=0.0.4; charset=utf-8')
+        lines = resp.data.splitlines()
+        self.assertIn('presence_analyzer_requests_total{endpoint="presence_weekday_view",status="200"} 1', lines)
+        self.assertIn('presence_analyzer_requests_total{endpoint="presence_weekday_view",status="501"} 1', lines)
+        self.assertIn('presence_analyzer_request_duration_seconds_count{endpoint="presence_weekday_view"} 2', lines)
+        self.assertIn('presence_analyzer_request_duration_seconds_bucket{endpoint="batch_view",le="+Inf"} 1', lines)
+        self.assertIn('presence_analyzer_response_size_bytes_count{endpoint="batch_view"} 0', lines)
+        self.assertIn('# TYPE presence_analyzer_cache_events_total counter', lines)
+        self.assertTrue(any(line.startswith('presence_analyzer_cache_events_total{event="hits"} ') for line in lines))
 
-    def get(self, key):
+    def test_metrics_view__should_get_failing_request__result_is_counted_as_500(self):
         """
-        Gets value for given key.
-        :param mixed key:
-        :return mixed :
+        Test requests failed with unhandled exception are recorded.
         """
+        registry_temp = main.registry
+        propagate = main.app.config.get('PROPAGATE_EXCEPTIONS')
+        main.registry = views.registry = metrics.Metrics()
+        main.app.config['PROPAGATE_EXCEPTIONS'] = False
         try:
-            return self._cache[key]
-        except KeyError:
-            return None
+            self.assertEqual(self.client.get('/api/v1/presence_start_end/999').status_code, 500)
+            lines = self.client.get('/metrics').data.splitlines()
+        finally:
+            main.registry = views.registry = registry_temp
+            main.app.config['PROPAGATE_EXCEPTIONS'] = propagate
+        self.assertIn('presence_analyzer_requests_total{endpoint="presence_start_end_view",status="500"} 1', lines)
+        self.assertIn('presence_analyzer_request_duration_seconds_count{endpoint="presence_start_end_view"} 1', lines)
+
+    def test_batch_view__should_get_user_list__result_is_statistics_per_user(self):
+        """
+        Test batch statistics.
+        """
+        resp = self.client.get('/api/v1/batch?users=10,9&stats=mean_time_weekday,presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), [u'10', u'9'])
+        self.assertIsNone(data[u'9'])
+        self.assertItemsEqual(data[u'10'].keys(), [u'mean_time_weekday', u'presence_weekday'])
+        single = self.client.get('/api/v1/presence_weekday/10', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertListEqual(data[u'10'][u'presence_weekday'], json.loads(single.data)[1:])
+
+    def test_batch_view__should_get_all_users__result_is_every_statistic(self):
+        """
+        Test batch statistics of all users.
+        """
+        data = json.loads(self.client.get('/api/v1/batch').data)
+        self.assertItemsEqual(data.keys(), [u'10', u'11'])
+        self.assertItemsEqual(data[u'11'].keys(), utils.STATISTICS.keys())
+
+    def test_batch_view__should_get_invalid_arguments__result_is_400_http_exception(self):
+        """
+        Test batch with invalid arguments.
+        """
+        self.assertEqual(self.client.get('/api/v1/batch?stats=unknown').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/batch?users=a,b').status_code, 400)
+
+    def test_presence_weekday_view__should_get_date_range__result_is_range_presence_only(self):
+        """
+        Test date range filtering.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-12', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertListEqual(data[1:], [[u'Mon', 0], [u'Tue', 0], [u'Wed', 24465], [u'Thu', 23705], [u'Fri', 0], [u'Sat', 0], [u'Sun', 0]])
+
+        resp = self.client.get('/api/v1/presence_start_end/10?from=2013-09-13', headers=headers)
+        self.assertDictEqual(json.loads(resp.data), {
+            u'3': {u'start': u'1970 01 01 19:48:46', u'end': u'1970 01 01 20:23:51', u'weekday': u'Thu'},
+        })
+
+    def test_mean_time_weekday_view__should_get_invalid_date_range__result_is_400_http_exception(self):
+        """
+        Test invalid date range.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        for query in ('from=2013-13-01', 'to=yesterday', 'from=2013-09-12&to=2013-09-11'):
+            resp = self.client.get('/api/v1/mean_time_weekday/10?' + query, headers=headers)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_percentile_weekday_view__should_get_user__result_is_percentiles_of_weekdays(self):
+        """
+        Test percentiles of presence per weekday.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/percentile_weekday/10', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertListEqual([entry['weekday'] for entry in data], [u'Tue', u'Wed', u'Thu'])
+        self.assertDictEqual(data[2], {
+            u'weekday': u'Thu',
+            u'count': 2,
+            u'interval': {u'p50': 2130, u'p90': 23730},
+            u'start': {u'p50': 38910, u'p90': 71310},
+            u'end': {u'p50': 62610, u'p90': 73410},
+        })
+
+        resp = self.client.get('/api/v1/percentile_weekday/10?from=2013-09-13&percentiles=10,100', headers=headers)
+        self.assertListEqual(json.loads(resp.data), [{
+            u'weekday': u'Thu',
+            u'count': 1,
+            u'interval': {u'p10': 2130, u'p100': 2130},
+            u'start': {u'p10': 71310, u'p100': 71310},
+            u'end': {u'p10': 73410, u'p100': 73410},
+        }])
+
+    def test_percentile_weekday_view__should_get_invalid_arguments__result_is_http_exception(self):
+        """
+        Test percentiles of unknown user and invalid percentiles.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        self.assertEqual(self.client.get('/api/v1/percentile_weekday/99', headers=headers).status_code, 404)
+        for query in ('percentiles=0', 'percentiles=50,101', 'percentiles=median', 'percentiles=', 'to=2013-02-30'):
+            resp = self.client.get('/api/v1/percentile_weekday/10?' + query, headers=headers)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_presence_trend_view__should_get_period__result_is_totals_and_means_per_period(self):
+        """
+        Test weekly and monthly presence trend.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        resp = self.client.get('/api/v1/presence_trend/10', headers=headers)
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(json.loads(resp.data), [
+            {u'start': u'2013-09-10', u'end': u'2013-09-15', u'count': 3, u'total': 78217, u'mean': 78217 / 3.0},
+            {u'start': u'2013-09-16', u'end': u'2013-09-19', u'count': 1, u'total': 2105, u'mean': 2105.0},
+        ])
+        resp = self.client.get('/api/v1/presence_trend/10?period=month&from=2013-08-01&to=2013-09-11', headers=headers)
+        self.assertListEqual(json.loads(resp.data), [
+            {u'start': u'2013-09-10', u'end': u'2013-09-11', u'count': 2, u'total': 54512, u'mean': 27256.0},
+        ])
+        resp = self.client.get('/api/v1/presence_trend/10?from=2014-01-01', headers=headers)
+        self.assertListEqual(json.loads(resp.data), [])
+
+    def test_presence_trend_view__should_get_invalid_arguments__result_is_http_exception(self):
+        """
+        Test trend of unknown user and period.
+        """
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        self.assertEqual(self.client.get('/api/v1/presence_trend/99', headers=headers).status_code, 404)
+        self.assertEqual(self.client.get('/api/v1/presence_trend/10?period=day', headers=headers).status_code, 400)
 
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
@@ -229,12 +485,103 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(result.headers[0], ('Content-Type', u'application/json'))
         self.assertEqual(expected, result.response[0])
 
+    def test_conditional__should_get_matching_etag__result_is_view_not_called(self):
+        """
+        Test conditional decorator.
+        """
+        calls = []
+
+        @utils.conditional(lambda: 'v1')
+        @utils.jsonify
+        def test():
+            """
+            Test function.
+            """
+            calls.append(1)
+            return 'test'
+
+        with main.app.test_request_context('/test?a=1'):
+            etag = test().get_etag()[0]
+        with main.app.test_request_context('/test?a=1', headers={'If-None-Match': 'W/"{0}"'.format(etag)}):
+            self.assertEqual(test().status_code, 304)
+        with main.app.test_request_context('/test?a=2', headers={'If-None-Match': 'W/"{0}"'.format(etag)}):
+            self.assertEqual(test().status_code, 200)
+        self.assertEqual(len(calls), 2)
+
+    def test_jsonify__should_accept_gzip__result_is_compressed_body(self):
+        """
+        Test content coding negotiation.
+        """
+        @utils.jsonify
+        def test():
+            """
+            Test function.
+            """
+            return ['test'] * 200
+
+        with main.app.test_request_context('/', headers={'Accept-Encoding': 'gzip, deflate'}):
+            result = test()
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', result.headers['Vary'])
+        self.assertEqual(json.loads(zlib.decompress(result.data, 16 + zlib.MAX_WBITS)), ['test'] * 200)
+
+        with main.app.test_request_context('/', headers={'Accept-Encoding': 'deflate'}):
+            result = test()
+        self.assertEqual(result.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(result.data)), ['test'] * 200)
+
+        with main.app.test_request_context('/'):
+            result = test()
+        self.assertNotIn('Content-Encoding', result.headers)
+
+    def test_jsonify__should_get_small_body__result_is_not_compressed(self):
+        """
+        Test compression threshold.
+        """
+        @utils.jsonify
+        def test():
+            """
+            Test function.
+            """
+            return 'test'
+
+        with main.app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+            result = test()
+        self.assertNotIn('Content-Encoding', result.headers)
+        self.assertEqual(result.data, '"test"')
+
+    def test_json_body__should_encode_twice__result_is_compressed_once(self):
+        """
+        Test compressed body is reused.
+        """
+        body = utils.JSONBody(utils.dumps(['test'] * 200))
+        self.assertIs(body.encode_as('gzip'), body.encode_as('gzip'))
+        self.assertEqual(zlib.decompress(body.encode_as('deflate')), body)
+
+    def test_load_serializer__should_get_missing_module__result_is_next_module_used(self):
+        """
+        Test serializer fallback.
+        """
+        result = utils.load_serializer(('missing_json_module', 'json'))
+        self.assertIs(result, json.dumps)
+        self.assertRaises(ImportError, utils.load_serializer, ('missing_json_module',))
+
+    def test_stream_json__should_get_small_buffer__result_is_valid_json_in_pieces(self):
+        """
+        Test streamed JSON object.
+        """
+        items = [(i, {'value': i}) for i in xrange(10)]
+        pieces = list(utils.stream_json(items, buffer_size=20))
+        self.assertGreater(len(pieces), 2)
+        self.assertDictEqual(json.loads(''.join(pieces)), dict((str(i), {'value': i}) for i in xrange(10)))
+        self.assertEqual(''.join(utils.stream_json([])), '{}')
+
     def test_get_data__should_set_value_in_cache__result_is_fresh_data_from_get_data(self):
         """
         Test get_data
         """
-        cache_temp = utils.simple_cache
-        utils.simple_cache = SimpleCacheDummy()
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
         expected = {1: 'user'}
 
         @utils.cache(60)
@@ -246,18 +593,18 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
         result = get_data()
         self.assertEqual(expected, result)
-        self.assertEqual(expected, utils.simple_cache.get('user-data'))
-        # sets previous state to simple_cache global variable at utils package
-        utils.simple_cache = cache_temp
+        self.assertEqual(expected, utils.data_cache.get(utils.cache_key(get_data, (), {}))[0])
+        self.assertEqual(utils.data_cache.stats['misses'], 1)
+        # sets previous state to data_cache global variable at utils package
+        utils.data_cache = cache_temp
 
     def test_get_data__should_not_set_value_in_cache__result_is_cached_data_from_get_data(self):
         """
         Test get data.
         """
-        cache_temp = utils.simple_cache
-        utils.simple_cache = SimpleCacheDummy()
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
         expected = {2: 'user 2'}
-        utils.simple_cache.set('user-data', expected, 15)
         not_expected = {1: 'user'}
 
         @utils.cache(60)
@@ -267,64 +614,251 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             """
             return not_expected
 
+        utils.data_cache.set(utils.cache_key(get_data, (), {}), expected, 15)
         result = get_data()
         self.assertEqual(expected, result)
-        self.assertEqual(expected, utils.simple_cache.get('user-data'))
-        # sets previous state to simple_cache global variable at utils package
-        utils.simple_cache = cache_temp
+        self.assertEqual(utils.data_cache.stats['hits'], 1)
+        # sets previous state to data_cache global variable at utils package
+        utils.data_cache = cache_temp
+
+    def test_cache__should_call_with_different_arguments__result_is_value_per_key(self):
+        """
+        Test cache keys.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+        calls = []
+
+        @utils.cache(60)
+        def double(value):
+            """
+            Function which replace mock.
+            """
+            calls.append(value)
+            return value * 2
+
+        self.assertListEqual([double(1), double(2), double(1)], [2, 4, 2])
+        self.assertListEqual(calls, [1, 2])
+        self.assertEqual(utils.data_cache.stats['recomputes'], 2)
+        utils.data_cache = cache_temp
+
+    def test_cache__should_get_expired_value__result_is_stale_value_while_refreshing(self):
+        """
+        Test stale value is served while other thread holds the key lock.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+
+        @utils.cache(60, stale=True)
+        def get_data():
+            """
+            Function which replace mock.
+            """
+            return 'fresh'
+
+        key = utils.cache_key(get_data, (), {})
+        utils.data_cache.set(key, 'stale', -1)
+        utils.data_cache.acquire(key)
+        try:
+            self.assertEqual(get_data(), 'stale')
+        finally:
+            utils.data_cache.release(key)
+        self.assertEqual(get_data(), 'fresh')
+        self.assertEqual(utils.data_cache.stats['stale'], 1)
+        utils.data_cache = cache_temp
+
+    def test_lru_cache__should_exceed_max_size__result_is_least_recently_used_evicted(self):
+        """
+        Test LRU eviction.
+        """
+        lru = utils.LRUCache(max_size=2)
+        lru.set('a', 1, 60)
+        lru.set('b', 2, 60)
+        lru.get('a')
+        lru.set('c', 3, 60)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a')[0], 1)
+        self.assertEqual(lru.stats['evictions'], 1)
+
+    def test_lru_cache__should_evict_and_clear_locked_key__result_is_lock_kept_until_released(self):
+        """
+        Test key lock held during eviction or clear still excludes others.
+        """
+        lru = utils.LRUCache(max_size=1)
+        lru.set('a', 1, 60)
+        self.assertTrue(lru.acquire('a'))
+        lru.set('b', 2, 60)
+        lru.clear()
+        self.assertFalse(lru.acquire('a', False))
+        lru.release('a')
+        self.assertDictEqual(lru.key_locks, {})
+        self.assertTrue(lru.acquire('a', False))
+        lru.release('a')
+
+    def test_cache__should_get_exception__result_is_key_lock_dropped(self):
+        """
+        Test key lock of failed computation is not leaked.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+
+        @utils.cache(60)
+        def get_data():
+            """
+            Function which replace mock.
+            """
+            raise IOError
+
+        self.assertRaises(IOError, get_data)
+        self.assertDictEqual(utils.data_cache.key_locks, {})
+        utils.data_cache = cache_temp
+
+    def test_export_csv__should_exceed_buffer_size__result_is_many_pieces(self):
+        """
+        Test CSV export is yielded in pieces.
+        """
+        records = [(user_id, 'Mon', 1, 2, 2.0, 3.0, 5.0) for user_id in xrange(100)]
+        pieces = list(utils.export_csv(records, buffer_size=256))
+        self.assertGreater(len(pieces), 5)
+        self.assertEqual(''.join(pieces).count('\n'), 101)
+        pieces = list(utils.export_ndjson(records, buffer_size=256))
+        self.assertGreater(len(pieces), 5)
+        self.assertEqual(''.join(pieces).count('\n'), 100)
+
+    def test_parse_date_range__should_get_invalid_range__result_is_value_error(self):
+        """
+        Test parsing date range limits.
+        """
+        self.assertEqual(utils.parse_date_range('2013-09-10', None), (735121, None))
+        self.assertRaises(ValueError, utils.parse_date_range, '2013-09-10', '2013-09-09')
+        self.assertRaises(ValueError, utils.parse_date_range, None, '10-09-2013')
+
+    def test_histogram__should_observe_values__result_is_cumulative_buckets(self):
+        """
+        Test histogram samples.
+        """
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertListEqual(list(histogram.samples('x', 'a="b"')), [
+            'x_bucket{a="b",le="1"} 2',
+            'x_bucket{a="b",le="10"} 3',
+            'x_bucket{a="b",le="+Inf"} 4',
+            'x_sum{a="b"} 56.5',
+            'x_count{a="b"} 4',
+        ])
+
+    def test_get_data__should_get_glob__result_is_data_of_all_files(self):
+        """
+        Test DATA_CSV given as glob.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+        main.app.config.update({'DATA_CSV': os.path.join(os.path.dirname(TEST_DATA_CSV), 'test_*.csv')})
+        try:
+            data = utils.get_data()
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            utils.data_cache = cache_temp
+        self.assertListEqual(data.users(), [10, 11])
+        self.assertIsInstance(utils.loaders['memory', main.app.config['DATA_CSV'].replace('test_data', 'test_*')], ingest.ShardedLoader)
 
     def test_get_data(self):
         """
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
-        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertIsInstance(data, store.PresenceStore)
+        self.assertListEqual(data.users(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
-        self.assertIn(sample_date, data[10])
-        self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
+        items = data.slice(10)
+        self.assertIn(sample_date.toordinal(), items.days)
+        position = list(items.days).index(sample_date.toordinal())
         self.assertEqual(
-            data[10][sample_date]['start'],
-            datetime.time(9, 39, 5)
+            items.starts[position],
+            utils.seconds_since_midnight(datetime.time(9, 39, 5))
         )
 
     def test_group_by_weekday__should_calculate_start_end_interval__result_is_list_of_intervals(self):
         """
         Test group by weekday.
         """
-        date1 = datetime.date(2000, 1, 1)
-        start1 = datetime.time(0, 0, 10)
-        end1 = datetime.time(0, 0, 30)
-        date2 = datetime.date(2000, 1, 8)
-        start2 = datetime.time(0, 0, 20)
-        end2 = datetime.time(0, 0, 40)
-        data = {
-            date1: {'start': start1, 'end': end1},
-            date2: {'start': start2, 'end': end2}
-        }
+        data = store.PresenceStore.from_rows([
+            (1, datetime.date(2000, 1, 1).toordinal(), 10, 30),
+            (1, datetime.date(2000, 1, 8).toordinal(), 20, 40),
+        ])
 
-        result = utils.group_by_weekday(data)
+        result = utils.group_by_weekday(data.slice(1))
         expected = [[], [], [], [], [], [20, 20], []]
 
-        self.assertListEqual(expected, result)
+        self.assertListEqual(expected, [list(intervals) for intervals in result])
 
     def test_group_by_weekday_start_end__should_group_by_weekday__result_dict_of_integers_per_weekday(self):
         """
         Test group by weekday start end.
         """
-        date1 = datetime.date(2000, 1, 1)
-        start1 = datetime.time(0, 0, 10)
-        end1 = datetime.time(0, 0, 30)
-        date2 = datetime.date(2000, 1, 8)
-        start2 = datetime.time(0, 0, 20)
-        end2 = datetime.time(0, 0, 40)
-        data = {
-            date1: {'start': start1, 'end': end1},
-            date2: {'start': start2, 'end': end2}
-        }
-        result = utils.group_by_weekday_start_end(data)
-        expected = {5: {'weekday': 'Sat', 'start': [10, 20], 'end': [30, 40]}}
-        self.assertDictEqual(result, expected)
+        data = store.PresenceStore.from_rows([
+            (1, datetime.date(2000, 1, 1).toordinal(), 10, 30),
+            (1, datetime.date(2000, 1, 8).toordinal(), 20, 40),
+        ])
+        result = utils.group_by_weekday_start_end(data.slice(1))
+        self.assertListEqual(result.keys(), [5])
+        self.assertEqual(result[5]['weekday'], 'Sat')
+        self.assertListEqual(list(result[5]['start']), [10, 20])
+        self.assertListEqual(list(result[5]['end']), [30, 40])
+
+    def test_get_users_data__should_parse_xml__result_is_users_with_avatars(self):
+        """
+        Test parsing users xml.
+        """
+        main.app.config.update({'USERS_DATA': TEST_USERS_XML})
+        result = utils.get_users_data()
+        self.assertItemsEqual(result.keys(), [10, 11, 12])
+        self.assertDictEqual(result[11], {
+            'name': 'User 11',
+            'avatar': 'https://intranet.example.com:443/api/images/users/11',
+        })
+        self.assertIs(utils.get_users_data(), result)
+
+    def test_get_users_data__should_get_missing_file__result_is_empty_dict(self):
+        """
+        Test missing users xml.
+        """
+        main.app.config.update({'USERS_DATA': TEST_USERS_XML + '.missing'})
+        self.assertDictEqual(utils.get_users_data(), {})
+
+    def test_weekday_stats__should_aggregate_user_rows__result_is_same_as_grouping_rows(self):
+        """
+        Test aggregate index gives the same results as grouping rows.
+        """
+        data = utils.get_data()
+        for user_id in data.users():
+            stats = data.weekday_stats(user_id)
+            weekdays = utils.group_by_weekday(data.slice(user_id))
+            self.assertListEqual(
+                utils.mean_time_weekday(stats),
+                [(calendar.day_abbr[day], utils.mean(items)) for day, items in enumerate(weekdays)]
+            )
+            self.assertListEqual(
+                utils.presence_weekday(stats),
+                [(calendar.day_abbr[day], sum(items)) for day, items in enumerate(weekdays)]
+            )
+            self.assertDictEqual(
+                utils.presence_start_end(stats),
+                utils.avg_time_weekday(utils.group_by_weekday_start_end(data.slice(user_id)))
+            )
+
+    def test_weekday_stats__should_merge_stores__result_is_patched_index(self):
+        """
+        Test aggregate index after merge.
+        """
+        data = store.PresenceStore.from_rows([(10, 1, 10, 20), (11, 1, 10, 20)])
+        other = store.PresenceStore.from_rows([(10, 1, 30, 50), (10, 2, 30, 40)])
+        result = data.merge(other)
+        self.assertIs(result.weekday_stats(11), data.weekday_stats(11))
+        self.assertEqual(result.weekday_stats(10)[0], (1, 20, 30, 50))
+        self.assertEqual(result.weekday_stats(10)[1], (1, 10, 30, 40))
+        self.assertEqual(result.weekday_stats(10), result.aggregate(10))
 
     def test_avg_time_weekday__should_convert_list_of_datetime_to_weekday_avg__result_is_dict_of_avg_datetime(self):
         """
@@ -371,6 +905,1245 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         expected = 0
         self.assertEqual(expected, result)
 
+    def test_trend_periods__should_get_range__result_is_clipped_weeks_and_months(self):
+        """
+        Test periods of trend.
+        """
+        def day(year, month, number):
+            """
+            Day ordinal of date.
+            """
+            return datetime.date(year, month, number).toordinal()
+
+        self.assertListEqual(list(utils.trend_periods('week', day(2013, 12, 25), day(2014, 1, 9))), [
+            (day(2013, 12, 25), day(2013, 12, 29)),
+            (day(2013, 12, 30), day(2014, 1, 5)),
+            (day(2014, 1, 6), day(2014, 1, 9)),
+        ])
+        self.assertListEqual(list(utils.trend_periods('month', day(2013, 11, 15), day(2014, 2, 1))), [
+            (day(2013, 11, 15), day(2013, 11, 30)),
+            (day(2013, 12, 1), day(2013, 12, 31)),
+            (day(2014, 1, 1), day(2014, 1, 31)),
+            (day(2014, 2, 1), day(2014, 2, 1)),
+        ])
+        self.assertListEqual(list(utils.trend_periods('week', 10, 9)), [])
+
+    def test_presence_trend__should_get_rows__result_is_same_as_summed_rows(self):
+        """
+        Test trend against sums of rows of every period.
+        """
+        rows = [(1, 735000 + day, 30000 + 37 * day, 60000 + 53 * (day % 11)) for day in xrange(0, 200, 3)]
+        data = store.PresenceStore.from_rows(rows)
+        for period in utils.TREND_PERIODS:
+            for first, last in [(None, None), (735020, 735150), (734000, 735010)]:
+                result = utils.presence_trend(data, 1, period, first, last)
+                for entry in result:
+                    lo = datetime.datetime.strptime(entry['start'], '%Y-%m-%d').toordinal()
+                    hi = datetime.datetime.strptime(entry['end'], '%Y-%m-%d').toordinal()
+                    intervals = [end - start for _, day, start, end in rows if lo <= day <= hi]
+                    self.assertEqual((entry['count'], entry['total']), (len(intervals), sum(intervals)))
+                self.assertEqual(sum(entry['count'] for entry in result), len([
+                    row for row in rows if (first is None or row[1] >= first) and (last is None or row[1] <= last)
+                ]))
+
+
+class PresenceStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def test_from_rows__should_sort_rows_by_user_and_date__result_is_contiguous_user_ranges(self):
+        """
+        Test store building.
+        """
+        data = store.PresenceStore.from_rows([
+            (11, 734000, 10, 20),
+            (10, 734002, 30, 40),
+            (10, 734001, 50, 60),
+        ])
+        self.assertEqual(len(data), 3)
+        self.assertListEqual(list(data.user_ids), [10, 10, 11])
+        self.assertListEqual(list(data.days), [734001, 734002, 734000])
+        self.assertDictEqual(data.offsets, {10: (0, 2), 11: (2, 3)})
+        self.assertIn(10, data)
+        self.assertNotIn(12, data)
+
+    def test_from_rows__should_get_duplicated_date__result_is_last_row_wins(self):
+        """
+        Test duplicated entries.
+        """
+        data = store.PresenceStore.from_rows([
+            (10, 734001, 10, 20),
+            (10, 734001, 30, 40),
+        ])
+        self.assertListEqual([list(column) for column in data.slice(10)], [[734001], [30], [40]])
+
+    def test_weekday_stats__should_get_date_range__result_is_same_as_filtered_rows(self):
+        """
+        Test date range stats against aggregates of filtered rows.
+        """
+        rows = [(user_id, 734000 + day, 100 * day + user_id, 200 * day) for user_id in (1, 2) for day in xrange(0, 60, user_id)]
+        data = store.PresenceStore.from_rows(rows)
+        for first, last in [(None, None), (734010, None), (None, 734030), (734005, 734040), (734013, 734013), (733000, 733100)]:
+            for user_id in (1, 2):
+                expected = store.PresenceStore.from_rows([
+                    row for row in rows
+                    if row[0] == user_id and (first is None or row[1] >= first) and (last is None or row[1] <= last)
+                ] or [(user_id, 1, 0, 0)])
+                stats = data.weekday_stats(user_id, first, last)
+                if not expected.slice(user_id).days[0] == 1:
+                    self.assertEqual(stats, expected.weekday_stats(user_id))
+                else:
+                    self.assertTrue(all(entry.count == 0 for entry in stats))
+
+    def test_total_stats__should_get_users__result_is_stats_of_their_rows(self):
+        """
+        Test sums of weekday stats over users.
+        """
+        rows = [(user_id, 734000 + day, 100 * day + user_id, 200 * day) for user_id in (1, 2, 3) for day in xrange(0, 30, user_id)]
+        data = store.PresenceStore.from_rows(rows)
+        expected = [
+            store.WeekdayStats(*[sum(values) for values in zip(first, second)])
+            for first, second in zip(data.weekday_stats(1), data.weekday_stats(3))
+        ]
+        self.assertListEqual(list(data.total_stats([1, 3, 9])), expected)
+        self.assertEqual(data.total_stats(), data.total_stats([1, 2, 3]))
+        self.assertEqual(data.total_stats([9]), tuple(store.WeekdayStats(0, 0, 0, 0) for _ in xrange(7)))
+
+    def test_quantile_sketches__should_get_date_range__result_is_sketches_of_filtered_rows(self):
+        """
+        Test sketches of date range against sketches of filtered rows.
+        """
+        rows = [(1, 734000 + day, 30000 + 97 * day, 60000 + 131 * day) for day in xrange(60)]
+        data = store.PresenceStore.from_rows(rows)
+        sketches = data.quantile_sketches(1)
+        self.assertIs(data.quantile_sketches(1), sketches)
+        self.assertEqual(sum(len(triple[0]) for triple in sketches), 60)
+        for first, last in [(734010, None), (None, 734030), (734013, 734013)]:
+            expected = store.PresenceStore.from_rows([
+                row for row in rows if (first is None or row[1] >= first) and (last is None or row[1] <= last)
+            ])
+            self.assertEqual(data.quantile_sketches(1, first, last), expected.quantile_sketches(1))
+
+    def test_weekday__should_use_day_ordinal__result_is_same_as_date_weekday(self):
+        """
+        Test weekday of day ordinal.
+        """
+        date = datetime.date(2013, 9, 12)
+        self.assertEqual(store.weekday(date.toordinal()), date.weekday())
+
+
+class QuantileSketchTestCase(unittest.TestCase):
+    """
+    Quantile sketch tests.
+    """
+
+    def test_quantile__should_get_values__result_is_close_to_exact_percentile(self):
+        """
+        Test quantiles within half of resolution of exact percentiles.
+        """
+        values = [(i * 7919) % 86400 for i in xrange(1000)]
+        result = sketch.QuantileSketch.from_values(values)
+        self.assertEqual(len(result), 1000)
+        self.assertLessEqual(len(result.bins), 86400 / result.resolution)
+        ordered = sorted(values)
+        for fraction in (0.01, 0.5, 0.9, 1.0):
+            exact = ordered[int(-(-fraction * len(values) // 1)) - 1]
+            self.assertLessEqual(abs(result.quantile(fraction) - exact), result.resolution / 2)
+        self.assertIsNone(sketch.QuantileSketch().quantile(0.5))
+
+    def test_merge__should_get_two_sketches__result_is_sketch_of_all_values(self):
+        """
+        Test merged sketch equal to sketch of joined values.
+        """
+        first, second = range(0, 5000, 7), range(3000, 9000, 11)
+        merged = sketch.QuantileSketch.from_values(first).merge(sketch.QuantileSketch.from_values(second))
+        self.assertEqual(merged, sketch.QuantileSketch.from_values(first + second))
+        self.assertEqual(len(merged), len(first) + len(second))
+
+    def test_build_sketches__should_get_rows__result_is_sketches_per_weekday(self):
+        """
+        Test sketches of intervals, starts and ends grouped by weekday.
+        """
+        result = sketch.build_sketches([(0, 100, 3600, 3700), (0, 200, 7200, 7400), (4, 60, 0, 60)])
+        self.assertEqual(len(result), 7)
+        self.assertListEqual([len(triple[0]) for triple in result], [2, 0, 0, 0, 1, 0, 0])
+        self.assertListEqual([entry.quantile(1.0) for entry in result[0]], [210, 7230, 7410])
+
+
+class PresenceParserTestCase(unittest.TestCase):
+    """
+    CSV ingestion tests.
+    """
+
+    def test_parse_stream__should_get_malformed_lines__result_is_errors_with_line_numbers(self):
+        """
+        Test malformed lines are reported and skipped.
+        """
+        parser = ingest.read_presence(TEST_DATA_CSV)
+        self.assertListEqual(
+            [number for number, _ in parser.errors],
+            [11, 12]
+        )
+        data = parser.store()
+        self.assertEqual(len(data.slice(11).days), 6)
+        self.assertEqual(len(data), 10)
+
+    def test_parse_stream__should_split_lines_between_chunks__result_is_same_as_single_chunk(self):
+        """
+        Test chunked reading.
+        """
+        expected = ingest.read_presence(TEST_DATA_CSV)
+        result = ingest.read_presence(TEST_DATA_CSV, chunk_size=7)
+        self.assertEqual(result.columns, expected.columns)
+        self.assertEqual(result.errors, expected.errors)
+        self.assertEqual(result.offset, expected.offset)
+
+    def test_parse_lines__should_get_too_large_user_id__result_is_line_skipped(self):
+        """
+        Test user ids not fitting integer columns are malformed.
+        """
+        parser = ingest.PresenceParser()
+        parser.parse_lines(['10,2013-09-10,09:00:00,17:00:00', '4294967306,2013-09-10,09:00:00,17:00:00'], 1)
+        self.assertListEqual([number for number, _ in parser.errors], [2])
+        self.assertListEqual(list(parser.columns[0]), [10])
+
+    def test_parse_seconds__should_get_invalid_time__result_is_value_error(self):
+        """
+        Test time validation.
+        """
+        parser = ingest.PresenceParser()
+        self.assertEqual(parser.parse_seconds('01:02:03'), 3723)
+        self.assertRaises(ValueError, parser.parse_seconds, '24:00:00')
+        self.assertRaises(ValueError, parser.parse_seconds, '1:02:03')
+        self.assertRaises(ValueError, parser.parse_day, '2013-02-30')
+
+
+class PresenceLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.write('w', '10,2013-09-10,09:39:05,17:59:52\n10,2013-09-11,09:19:52,16:07:37\n')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, mode, content):
+        """
+        Writes content to data file and moves its mtime forward.
+        """
+        with open(self.path, mode) as stream:
+            stream.write(content)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_load__should_get_unchanged_file__result_is_same_data(self):
+        """
+        Test unchanged file is not parsed again.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        data = loader.load()
+        self.assertIs(loader.load(), data)
+
+    def test_load__should_get_appended_lines__result_is_merged_tail(self):
+        """
+        Test only appended tail is parsed.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        data = loader.load()
+        offset = loader.offset
+        self.write('a', '11,2013-09-10,09:00:00,17:00:00\n10,2013-09-11,08:00:00,16:00:00')
+        result = loader.load()
+
+        self.assertIsNot(result, data)
+        self.assertNotEqual(result.version, data.version)
+        self.assertListEqual(result.users(), [10, 11])
+        self.assertListEqual(list(result.slice(10).starts), [34745, 28800])
+        self.assertEqual(loader.offset, offset + 32)
+        self.assertEqual(loader.line, 4)
+
+    def test_load__should_get_completed_last_line__result_is_line_parsed_again(self):
+        """
+        Test unterminated line is parsed again when it gets completed.
+        """
+        self.write('a', '12,2013-09-10,09:00:00,17:0')
+        loader = ingest.PresenceLoader(self.path)
+        self.assertNotIn(12, loader.load())
+        self.write('a', '0:00\n')
+        self.assertListEqual(list(loader.load().slice(12).ends), [61200])
+
+    def test_load__should_parse_file__result_is_load_metrics(self):
+        """
+        Test loads are recorded in metrics.
+        """
+        registry_temp = ingest.registry
+        ingest.registry = metrics.Metrics()
+        try:
+            loader = ingest.PresenceLoader(self.path)
+            loader.load()
+            self.write('a', '12,2013-09-10,09:00:00,17:00:00\n')
+            loader.load()
+            self.assertDictEqual(dict(ingest.registry.loads), {'full': 1, 'append': 1})
+            self.assertDictEqual(dict(ingest.registry.rows), {'full': 2, 'append': 1})
+        finally:
+            ingest.registry = registry_temp
+
+    def test_load__should_get_truncated_file__result_is_full_reload(self):
+        """
+        Test truncated file is parsed from scratch.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        loader.load()
+        self.write('w', '11,2013-09-10,09:00:00,17:00:00\n')
+        self.assertListEqual(loader.load().users(), [11])
+
+    def test_load__should_get_rewritten_file__result_is_full_reload(self):
+        """
+        Test file rewritten in place is parsed from scratch.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        loader.load()
+        self.write('w', '11,2013-09-10,09:39:05,17:59:52\n10,2013-09-11,09:19:52,16:07:37\n10,2013-09-12,09:19:52,16:07:37\n')
+        self.assertListEqual(loader.load().users(), [10, 11])
+        self.assertEqual(len(loader.load()), 3)
+
+    def test_merge__should_get_rows_of_both_stores__result_is_other_store_overrides(self):
+        """
+        Test merging stores.
+        """
+        data = store.PresenceStore.from_rows([(10, 1, 10, 20), (10, 2, 10, 20), (11, 1, 10, 20)])
+        other = store.PresenceStore.from_rows([(10, 2, 30, 40), (10, 3, 30, 40), (12, 1, 30, 40)])
+        result = data.merge(other)
+        self.assertListEqual(list(result.user_ids), [10, 10, 10, 11, 12])
+        self.assertListEqual(list(result.days), [1, 2, 3, 1, 1])
+        self.assertListEqual(list(result.starts), [10, 30, 30, 10, 30])
+
+    def test_merge__should_get_later_rows__result_is_same_index_as_full_build(self):
+        """
+        Test merging rows appended after user's last day extends the index.
+        """
+        rows = [(user_id, 734000 + day, 100 * day + user_id, 300 * day) for user_id in (1, 2) for day in xrange(40)]
+        data = store.PresenceStore.from_rows(rows[:25] + rows[40:50])
+        other = store.PresenceStore.from_rows(rows[25:40] + rows[50:])
+        result = data.merge(other)
+        expected = store.PresenceStore.from_rows(rows)
+        self.assertDictEqual(result.weekdays, expected.weekdays)
+        for column, expected_column in zip(result.order, expected.order):
+            self.assertListEqual(list(column), list(expected_column))
+        self.assertEqual(result.weekday_stats(2, 734010, 734030), expected.weekday_stats(2, 734010, 734030))
+
+
+class ShardedLoaderTestCase(unittest.TestCase):
+    """
+    Loading of many presence files tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.write('2013-08.csv', '10,2013-08-30,09:00:00,17:00:00\n11,2013-08-30,10:00:00,18:00:00\n')
+        self.write('2013-09.csv', '10,2013-09-10,09:39:05,17:59:52\n10,2013-09-11,09:19:52,16:07:37\n')
+        self.write('2013-10.csv', '11,2013-08-30,08:00:00,12:00:00\n12,2013-10-01,09:00:00,17:00:00\n')
+        self.pattern = os.path.join(self.directory, '*.csv')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content, mode='w'):
+        """
+        Writes content to file and moves its mtime forward.
+        """
+        path = os.path.join(self.directory, name)
+        with open(path, mode) as stream:
+            stream.write(content)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    def expected(self):
+        """
+        Store of all files concatenated in order.
+        """
+        parser = ingest.PresenceParser()
+        for path in ingest.expand_paths(self.pattern):
+            with open(path) as stream:
+                parser.parse_stream(stream)
+        return parser.store()
+
+    def assertStoreEqual(self, result, expected):
+        """
+        Compares rows and weekday index of stores.
+        """
+        self.assertListEqual(list(result.user_ids), list(expected.user_ids))
+        self.assertListEqual(list(result.days), list(expected.days))
+        self.assertListEqual(list(result.starts), list(expected.starts))
+        self.assertDictEqual(result.weekdays, expected.weekdays)
+        for column, expected_column in zip(result.order, expected.order):
+            self.assertListEqual(list(column), list(expected_column))
+
+    def test_expand_paths__should_get_globs_and_paths__result_is_ordered_paths(self):
+        """
+        Test expanding file patterns.
+        """
+        first = os.path.join(self.directory, '2013-08.csv')
+        self.assertListEqual(
+            [os.path.basename(path) for path in ingest.expand_paths([os.path.join(self.directory, '*-1*.csv'), first, self.pattern])],
+            ['2013-10.csv', '2013-08.csv', '2013-09.csv'],
+        )
+        self.assertIsInstance(ingest.make_loader(first), ingest.PresenceLoader)
+        self.assertIsInstance(ingest.make_loader(self.pattern), ingest.ShardedLoader)
+        self.assertIsInstance(ingest.make_loader([first]), ingest.ShardedLoader)
+
+    def test_load__should_get_many_files__result_is_later_files_override(self):
+        """
+        Test files parsed in process pool are merged in order.
+        """
+        loader = ingest.ShardedLoader(self.pattern, processes=2)
+        data = loader.load()
+        self.assertStoreEqual(data, self.expected())
+        self.assertListEqual(list(data.slice(11).starts), [28800])
+        self.assertIs(loader.load(), data)
+
+    def test_load__should_get_changed_files__result_is_only_changed_files_parsed(self):
+        """
+        Test unchanged files are reused.
+        """
+        loader = ingest.ShardedLoader(self.pattern, processes=1)
+        data = loader.load()
+        first = loader.loaders[os.path.join(self.directory, '2013-08.csv')].data
+        self.write('2013-09.csv', '10,2013-09-12,10:48:46,17:23:51\n', 'a')
+        self.write('2013-11.csv', '12,2013-11-04,09:00:00,17:00:00\n')
+        result = loader.load()
+        self.assertNotEqual(result.version, data.version)
+        self.assertIs(loader.loaders[os.path.join(self.directory, '2013-08.csv')].data, first)
+        self.assertStoreEqual(result, self.expected())
+
+        os.unlink(os.path.join(self.directory, '2013-10.csv'))
+        self.assertStoreEqual(loader.load(), self.expected())
+        self.assertEqual(len(loader.loaders), 3)
+
+
+class SQLiteStoreTestCase(unittest.TestCase):
+    """
+    SQLite backend tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.database = os.path.join(self.directory, 'data.sqlite')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.registry = ingest.registry
+        sqlstore.registry = metrics.Metrics()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        sqlstore.registry = self.registry
+        sqlstore.connections.opened.clear()
+        shutil.rmtree(self.directory)
+
+    def append(self, content):
+        """
+        Appends content to data file and moves its mtime forward.
+        """
+        with open(self.path, 'a') as stream:
+            stream.write(content)
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_load__should_get_csv__result_is_same_stats_as_memory_store(self):
+        """
+        Test SQL aggregates against in-memory store.
+        """
+        data = sqlstore.SQLiteLoader(self.path, self.database).load()
+        expected = ingest.PresenceLoader(self.path).load()
+        self.assertEqual(len(data), len(expected))
+        self.assertListEqual(data.users(), expected.users())
+        self.assertIn(10, data)
+        self.assertNotIn(12, data)
+        self.assertEqual(data.slice(11), expected.slice(11))
+        for user_id in expected:
+            for first, last in [(None, None), (735122, None), (None, 735123), (735121, 735122)]:
+                self.assertEqual(data.weekday_stats(user_id, first, last), expected.weekday_stats(user_id, first, last))
+        self.assertEqual(data.total_stats(), expected.total_stats())
+        self.assertEqual(data.total_stats([11, 12], 735122), expected.total_stats([11, 12], 735122))
+        for user_id in expected:
+            self.assertEqual(data.quantile_sketches(user_id), expected.quantile_sketches(user_id))
+            self.assertEqual(utils.presence_trend(data, user_id, 'month'), utils.presence_trend(expected, user_id, 'month'))
+            self.assertEqual(data.quantile_sketches(user_id, 735122), expected.quantile_sketches(user_id, 735122))
+
+    def test_load__should_get_appended_file__result_is_tail_inserted_and_resumed(self):
+        """
+        Test incremental ingest kept across restarts.
+        """
+        loader = sqlstore.SQLiteLoader(self.path, self.database)
+        data = loader.load()
+        self.append('\n12,2013-09-10,09:00:00,17:00:00\n10,2013-09-10,10:00:00,17:00:00\n')
+        result = loader.load()
+        self.assertNotEqual(result.version, data.version)
+        self.assertListEqual(result.users(), [10, 11, 12])
+        self.assertEqual(result.slice(10).starts[0], 36000)
+        self.assertDictEqual(dict(sqlstore.registry.rows), {'sqlite-full': 10, 'sqlite-append': 2})
+
+        restarted = sqlstore.SQLiteLoader(self.path, self.database).load()
+        self.assertEqual(restarted.version, result.version)
+        self.assertEqual(sum(sqlstore.registry.loads.values()), 2)
+
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.assertListEqual(loader.load().users(), [10, 11])
+        self.assertEqual(sqlstore.registry.loads['sqlite-full'], 2)
+
+    def test_connect__should_get_other_thread__result_is_connection_per_thread(self):
+        """
+        Test connections are kept per thread.
+        """
+        connection = sqlstore.connect(self.database)
+        self.assertIs(sqlstore.connect(self.database), connection)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(sqlstore.connect(self.database)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], connection)
+
+    def test_get_data__should_get_sqlite_backend__result_is_same_view_results(self):
+        """
+        Test views reading SQLite backend.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+        client = main.app.test_client()
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        config = dict(main.app.config)
+        main.app.config.update({'DATA_CSV': self.path, 'USERS_DATA': TEST_USERS_XML, 'DATA_BACKEND': 'memory'})
+        try:
+            expected = [client.get(url, headers=headers).data for url in ('/api/v1/presence_weekday/11?from=2013-09-10', '/api/v1/org/mean_time_weekday')]
+            main.app.config.update({'DATA_BACKEND': 'sqlite', 'DATA_SQLITE': self.database})
+            utils.data_cache.clear()
+            self.assertIsInstance(utils.get_data(), sqlstore.SQLiteStore)
+            result = [client.get(url, headers=headers).data for url in ('/api/v1/presence_weekday/11?from=2013-09-10', '/api/v1/org/mean_time_weekday')]
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+            utils.data_cache = cache_temp
+            utils.loaders.pop(('sqlite', self.path), None)
+            utils.loaders.pop(('memory', self.path), None)
+        self.assertListEqual(result, expected)
+
+    def test_get_loader__should_get_sqlite_backend_and_many_files__result_is_config_error(self):
+        """
+        Test SQLite backend rejects glob or list of data files.
+        """
+        config = dict(main.app.config)
+        path = os.path.join(self.directory, 'deploy.cfg')
+        try:
+            for pattern in (os.path.join(self.directory, '*.csv'), [self.path]):
+                main.app.config.update({'DATA_CSV': pattern, 'DATA_BACKEND': 'sqlite', 'DATA_SQLITE': self.database})
+                self.assertRaises(ValueError, utils.get_loader)
+            with open(path, 'w') as stream:
+                stream.write('DATA_CSV = {0!r}\nDATA_BACKEND = "sqlite"\n'.format([self.path]))
+            self.assertRaises(ValueError, script.make_app, config=path, refresh=False)
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.snapshot = os.path.join(self.directory, 'data.snapshot')
+        shutil.copy(TEST_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_read_snapshot__should_map_written_store__result_is_same_data(self):
+        """
+        Test snapshot round trip.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        data = loader.load()
+        snapshot.write_snapshot(self.snapshot, data, loader.state())
+        result, state = snapshot.read_snapshot(self.snapshot)
+
+        self.assertIsInstance(result.days, snapshot.MappedColumn)
+        self.assertDictEqual(state, loader.state())
+        self.assertDictEqual(result.offsets, data.offsets)
+        self.assertDictEqual(result.weekdays, data.weekdays)
+        for column, expected in zip(result.order, data.order):
+            self.assertIsInstance(column, snapshot.MappedColumn)
+            self.assertEqual(column[:], expected)
+        self.assertEqual(result.weekday_stats(11, 735120), data.weekday_stats(11, 735120))
+        for user_id in data.users():
+            self.assertEqual(result.slice(user_id), data.slice(user_id))
+        self.assertListEqual(list(result.ends), list(data.ends))
+        self.assertEqual(result.starts[-1], data.starts[-1])
+
+    def test_write_snapshot__should_get_umask__result_is_file_mode_of_open(self):
+        """
+        Test snapshot gets umask based mode.
+        """
+        loader = ingest.PresenceLoader(self.path)
+        data = loader.load()
+        umask = os.umask(0022)
+        try:
+            snapshot.write_snapshot(self.snapshot, data, loader.state())
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.snapshot).st_mode & 0777, 0644)
+
+    def test_load__should_get_missing_snapshot__result_is_snapshot_built_and_mapped(self):
+        """
+        Test first load builds snapshot.
+        """
+        data = ingest.PresenceLoader(self.path, self.snapshot).load()
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertIsInstance(data.user_ids, snapshot.MappedColumn)
+
+        data = ingest.PresenceLoader(self.path, self.snapshot).load()
+        self.assertIsInstance(data.user_ids, snapshot.MappedColumn)
+        self.assertListEqual(data.users(), [10, 11])
+
+    def test_load__should_get_newer_csv__result_is_snapshot_rebuilt(self):
+        """
+        Test snapshot is brought up to date with appended lines.
+        """
+        ingest.PresenceLoader(self.path, self.snapshot).load()
+        with open(self.path, 'a') as stream:
+            stream.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+
+        data = ingest.PresenceLoader(self.path, self.snapshot).load()
+        self.assertListEqual(data.users(), [10, 11, 12])
+        _, state = snapshot.read_snapshot(self.snapshot)
+        self.assertEqual(state['identity'][2], os.path.getsize(self.path))
+
+    def test_read_snapshot__should_get_invalid_file__result_is_snapshot_error(self):
+        """
+        Test invalid snapshot file.
+        """
+        with open(self.snapshot, 'w') as stream:
+            stream.write('not a snapshot' * 20)
+        self.assertRaises(snapshot.SnapshotError, snapshot.read_snapshot, self.snapshot)
+        with open(self.snapshot, 'w') as stream:
+            stream.write(snapshot.HEADER.pack('PASN', 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, ''))
+        self.assertRaises(snapshot.SnapshotError, snapshot.read_snapshot, self.snapshot)
+        data = ingest.PresenceLoader(self.path, self.snapshot).load()
+        self.assertListEqual(data.users(), [10, 11])
+
+
+class PreforkServerTestCase(unittest.TestCase):
+    """
+    Pre-fork server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA': TEST_USERS_XML})
+
+    def test_run__should_fork_workers__result_is_request_served_by_worker(self):
+        """
+        Test serving request with worker recycled after every request.
+        """
+        server = prefork.PreforkServer(main.app, '127.0.0.1', 0, workers=2, max_requests=1)
+        server.bind()
+        pid = os.fork()
+        if not pid:
+            try:
+                server.run()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+        server.server.server_close()
+        try:
+            url = 'http://127.0.0.1:{0}/api/v1/presence_weekday/10'.format(server.address[1])
+            for _ in xrange(3):
+                request = urllib2.Request(url, headers={'X-Requested-With': 'XMLHttpRequest'})
+                response = urllib2.urlopen(request, timeout=10)
+                self.assertEqual(response.getcode(), 200)
+                self.assertEqual(json.loads(response.read())[0], [u'Weekday', u'Presence (s)'])
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_load_data__should_load_data__result_is_cache_not_expiring(self):
+        """
+        Test data loaded for workers is not reloaded by them.
+        """
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+        prefork.load_data()
+        self.assertTrue(all(expires == float('inf') for _, expires in utils.data_cache.entries.values()))
+        self.assertFalse(prefork.data_changed())
+        utils.data_cache = cache_temp
+
+    def test_run__should_check_changed_data__result_is_reload_by_master(self):
+        """
+        Test master reloads data when periodic check finds it changed.
+        """
+        handlers = [signal.getsignal(signum) for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGALRM)]
+        calls = []
+
+        def reload_data():
+            """
+            Stops the server after the first reload.
+            """
+            calls.append(os.getpid())
+            server.alive = False
+
+        server = prefork.PreforkServer(
+            main.app, '127.0.0.1', 0, workers=1, check_interval=1,
+            preload=lambda: None, reload=reload_data, changed=lambda: True,
+        )
+        try:
+            server.run()
+        finally:
+            for signum, handler in zip((signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGALRM), handlers):
+                signal.signal(signum, handler)
+        self.assertListEqual(calls, [os.getpid()])
+        self.assertSetEqual(server.children, set())
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """
+    Synthetic data and benchmark tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_generate_presence__should_get_seed__result_is_same_parsable_rows(self):
+        """
+        Test generated presence data.
+        """
+        rows = benchmark.generate_presence(self.path, users=5, days=20, absence=0.2, seed=1)
+        parser = ingest.read_presence(self.path)
+        self.assertListEqual(parser.errors, [])
+        self.assertEqual(len(parser.columns[0]), rows)
+        self.assertGreater(rows, 50)
+        self.assertLess(rows, 100)
+        data = parser.store()
+        self.assertListEqual(data.users(), range(10, 15))
+        self.assertTrue(all(entry.count == 0 for entry in data.weekday_stats(10)[5:]))
+        with open(self.path) as stream:
+            content = stream.read()
+        benchmark.generate_presence(self.path, users=5, days=20, absence=0.2, seed=1)
+        with open(self.path) as stream:
+            self.assertEqual(stream.read(), content)
+
+    def test_generate_users__should_get_count__result_is_users_xml(self):
+        """
+        Test generated users.xml.
+        """
+        path = os.path.join(self.directory, 'users.xml')
+        benchmark.generate_users(path, users=3)
+        users = utils.parse_users_xml(path)
+        self.assertListEqual(sorted(users), [10, 11, 12])
+        self.assertEqual(users[12]['avatar'], 'https://intranet.example.com:443/api/images/users/12')
+
+    def test_run__should_get_dataset_sizes__result_is_report_per_size(self):
+        """
+        Test benchmark run on small datasets.
+        """
+        config = dict(main.app.config)
+        output = os.path.join(self.directory, 'report.txt')
+        with open(output, 'w') as stream:
+            reports = benchmark.isolated(benchmark.benchmark_dataset, self.directory, 3, 5, 2)
+            benchmark.print_report([reports], stream)
+        self.assertEqual(reports['users'], 3)
+        self.assertGreater(reports['parse_rows_per_s'], 0)
+        self.assertItemsEqual(reports['endpoints'].keys(), benchmark.ENDPOINTS)
+        self.assertGreater(reports['cache']['hits'], 0)
+        with open(output) as stream:
+            self.assertIn('parse_rows_per_s', stream.read())
+        self.assertDictEqual(dict(main.app.config), config)
+
+
+class RefresherTestCase(unittest.TestCase):
+    """
+    Background refreshing tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.csv')
+        self.users = os.path.join(self.directory, 'users.xml')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        shutil.copy(TEST_USERS_XML, self.users)
+        self.config = dict(main.app.config)
+        main.app.config.update({'DATA_CSV': self.path, 'USERS_DATA': self.users, 'DATA_SNAPSHOT': None})
+        self.cache = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        refresher.stop_refresher()
+        utils.data_cache = self.cache
+        utils.loaders.pop(('memory', self.path), None)
+        utils.users_cache.pop(self.users, None)
+        main.app.config.clear()
+        main.app.config.update(self.config)
+        shutil.rmtree(self.directory)
+
+    def touch(self, path, content):
+        """
+        Appends content to file and moves its mtime forward.
+        """
+        with open(path, 'a') as stream:
+            stream.write(content)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+    def test_start_refresher__should_get_changed_files__result_is_data_swapped_by_refresh_only(self):
+        """
+        Test requests read data loaded by refresh, not by themselves.
+        """
+        thread = refresher.start_refresher(3600)
+        self.assertIs(refresher.start_refresher(3600), thread)
+        data = utils.get_data()
+        self.assertListEqual(data.users(), [10, 11])
+
+        self.touch(self.path, '\n12,2013-09-10,09:00:00,17:00:00\n')
+        self.touch(self.users, '<!-- changed -->\n')
+        users = utils.get_users_data()
+        self.assertIs(utils.get_data(), data)
+        self.assertIs(utils.get_users_data(), users)
+
+        self.assertTrue(utils.refresh_data())
+        self.assertListEqual(utils.get_data().users(), [10, 11, 12])
+        self.assertIsNot(utils.get_users_data(), users)
+        self.assertFalse(utils.refresh_data())
+
+        refresher.stop_refresher()
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(utils.refreshing)
+
+    def test_run__should_get_interval__result_is_periodic_refresh(self):
+        """
+        Test refresher thread calls refresh until stopped, surviving errors.
+        """
+        calls = []
+
+        def refresh():
+            """
+            Fails on first call.
+            """
+            calls.append(time.time())
+            if len(calls) == 1:
+                raise IOError
+            return False
+
+        thread = refresher.Refresher(0.01, refresh)
+        thread.start()
+        deadline = time.time() + 5
+        while len(calls) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        thread.stop()
+        self.assertGreaterEqual(len(calls), 3)
+        self.assertFalse(thread.is_alive())
+
+    def test_start_refresher__should_not_load__result_is_data_loaded_by_thread(self):
+        """
+        Test first load left to the thread.
+        """
+        thread = refresher.start_refresher(3600, load=False)
+        deadline = time.time() + 5
+        while utils.get_loader().data is None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertListEqual(utils.get_data().users(), [10, 11])
+        self.assertTrue(thread.is_alive())
+
+    def test_make_app__should_get_warm_up__result_is_data_loaded(self):
+        """
+        Test application created lazily or warmed up.
+        """
+        config = os.path.join(self.directory, 'deploy.cfg')
+        with open(config, 'w') as stream:
+            stream.write('DATA_CSV = {0!r}\nUSERS_DATA = {1!r}\n'.format(self.path, self.users))
+        app = script.make_app(config=config, refresh=False)
+        self.assertIs(app, main.app)
+        self.assertIn('mean_time_weekday_view', app.view_functions)
+        self.assertIsNone(utils.get_loader().data)
+        script.make_app(config=config, refresh=False, warm_up=True)
+        self.assertIsNotNone(utils.get_loader().data)
+        self.assertIn(self.users, utils.users_cache)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves users.xml or avatar with ETag, fails on demand.
+    """
+
+    def do_GET(self):
+        """
+        Answers GET request.
+        """
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.failures:
+            server.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(server.body) + server.missing))
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """
+        Keeps test output clean.
+        """
+        pass
+
+
+class DownloadTestCase(unittest.TestCase):
+    """
+    Downloads of users.xml from stub HTTP server.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.xml')
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        with open(TEST_USERS_XML) as stream:
+            self.server.body = stream.read()
+        self.server.etag = '"v1"'
+        self.server.requests = []
+        self.server.failures = 0
+        self.server.missing = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/users.xml'.format(self.server.server_address[1])
+        self.session = utils.http_session(retries=2, backoff=0)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_download__should_get_unchanged_file__result_is_not_modified(self):
+        """
+        Test conditional download.
+        """
+        self.assertTrue(utils.download(self.url, self.path, self.session))
+        with open(self.path) as stream:
+            self.assertEqual(stream.read(), self.server.body)
+        self.assertFalse(utils.download(self.url, self.path, self.session))
+        self.assertEqual(self.server.requests[1].get('if-none-match'), '"v1"')
+
+        self.server.etag = '"v2"'
+        self.server.body = self.server.body.replace('User 12', 'User twelve')
+        self.assertTrue(utils.download(self.url, self.path, self.session))
+        self.assertEqual(utils.parse_users_xml(self.path)[12]['name'], 'User twelve')
+        self.assertListEqual(sorted(os.listdir(self.directory)), ['users.xml', 'users.xml.validators'])
+
+    def test_atomic_file__should_get_umask__result_is_file_mode_of_open(self):
+        """
+        Test atomically written file gets umask based mode.
+        """
+        umask = os.umask(0022)
+        try:
+            with utils.atomic_file(self.path) as stream:
+                stream.write(self.server.body)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0777, 0644)
+
+    def test_download__should_get_server_errors__result_is_retried(self):
+        """
+        Test retries of failed requests.
+        """
+        self.server.failures = 2
+        self.assertTrue(utils.download(self.url, self.path, self.session))
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.failures = 3
+        self.server.etag = '"v2"'
+        self.assertRaises(Exception, utils.download, self.url, self.path, self.session)
+
+    def test_download__should_get_truncated_body__result_is_file_kept(self):
+        """
+        Test interrupted download does not replace the file.
+        """
+        utils.download(self.url, self.path, self.session)
+        self.server.etag = '"v2"'
+        self.server.missing = 100
+        self.session.close()
+        self.assertRaises(Exception, utils.download, self.url, self.path, self.session, 1)
+        with open(self.path) as stream:
+            self.assertEqual(stream.read(), self.server.body)
+        self.assertListEqual(sorted(os.listdir(self.directory)), ['users.xml', 'users.xml.validators'])
+
+    def test_download_avatars__should_get_users__result_is_avatars_cached_and_revalidated(self):
+        """
+        Test parallel prefetch of avatars.
+        """
+        config = dict(main.app.config)
+        main.app.config['AVATARS_DIR'] = os.path.join(self.directory, 'avatars')
+        users = dict((user_id, {'avatar': self.url}) for user_id in (10, 11, 12))
+        users[13] = {'avatar': 'http://127.0.0.1:1/avatar'}
+        try:
+            first = avatars.download_avatars(users, self.session, 2)
+            second = avatars.download_avatars(users, self.session, 2)
+            cached = avatars.cached_avatars()
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+        self.assertDictEqual(first, {'downloaded': 3, 'not_modified': 0, 'failed': 1})
+        self.assertDictEqual(second, {'downloaded': 0, 'not_modified': 3, 'failed': 1})
+        self.assertEqual(cached, frozenset([10, 11, 12]))
+
+    def test_avatar_view__should_get_user__result_is_cached_avatar(self):
+        """
+        Test avatar proxy, its cache headers and local links in users listing.
+        """
+        self.server.body = '\x89PNG\r\n\x1a\n' + 'x' * 100
+        users_path = os.path.join(self.directory, 'users.xml')
+        with open(TEST_USERS_XML) as stream:
+            content = stream.read()
+        with open(users_path, 'w') as stream:
+            stream.write(content.replace('intranet.example.com', '127.0.0.1').replace(
+                '443', str(self.server.server_address[1])).replace('https', 'http'))
+        config = dict(main.app.config)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV, 'USERS_DATA': users_path})
+        client = main.app.test_client()
+        try:
+            resp = client.get('/avatars/10')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'image/png')
+            self.assertEqual(resp.data, self.server.body)
+            self.assertEqual(resp.cache_control.max_age, avatars.AVATAR_MAX_AGE)
+            etag = resp.headers['ETag']
+            resp = client.get('/avatars/10', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(len(self.server.requests), 1)
+            self.assertEqual(client.get('/avatars/99').status_code, 404)
+
+            resp = client.get('/api/v1/users', headers={'X-Requested-With': 'XMLHttpRequest'})
+            links = dict((entry['user_id'], entry['avatar']) for entry in json.loads(resp.data))
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+        self.assertEqual(links[10], '/avatars/10')
+        self.assertTrue(links[11].startswith('http://127.0.0.1:'))
+
+
+class StartupTestCase(unittest.TestCase):
+    """
+    Startup profile tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.config = os.path.join(self.directory, 'deploy.cfg')
+        with open(self.config, 'w') as stream:
+            stream.write('DATA_CSV = {0!r}\nUSERS_DATA = {1!r}\nTEAMS_DATA = {2!r}\n'.format(
+                os.path.abspath(TEST_DATA_CSV), os.path.abspath(TEST_USERS_XML), os.path.abspath(TEST_TEAMS_JSON)))
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_import_profiler__should_get_nested_imports__result_is_self_and_cumulative_time(self):
+        """
+        Test timings of nested imports.
+        """
+        with open(os.path.join(self.directory, 'startup_outer.py'), 'w') as stream:
+            stream.write('import time\nimport startup_inner\ntime.sleep(0.02)\n')
+        with open(os.path.join(self.directory, 'startup_inner.py'), 'w') as stream:
+            stream.write('import time\ntime.sleep(0.05)\n')
+        sys.path.insert(0, self.directory)
+        try:
+            with startup.ImportProfiler() as profiler:
+                __import__('startup_outer')
+        finally:
+            sys.path.remove(self.directory)
+            sys.modules.pop('startup_outer', None)
+            sys.modules.pop('startup_inner', None)
+        timings = dict((timing['module'], timing) for timing in profiler.report())
+        self.assertListEqual(sorted(timings), ['startup_inner', 'startup_outer'])
+        self.assertGreaterEqual(timings['startup_inner']['cumulative_s'], 0.05)
+        self.assertGreaterEqual(timings['startup_outer']['cumulative_s'], 0.07)
+        self.assertLess(timings['startup_outer']['self_s'], 0.05)
+
+    def test_measure__should_get_config__result_is_phases_and_imports_of_fresh_process(self):
+        """
+        Test startup profile and modules deferred until first use.
+        """
+        result = startup.measure(self.config, warm_up=True)
+        self.assertListEqual([phase[0] for phase in result['phases']], ['import', 'make_app', 'warm_up'])
+        self.assertGreaterEqual(result['process_s'], result['total_s'])
+        modules = set(timing['module'] for timing in result['imports'])
+        self.assertIn('presence_analyzer.views', modules)
+        self.assertIn('xml.etree.ElementTree', modules)
+        self.assertFalse([module for module in modules if module.split('.')[0] in ('requests', 'csv', 'multiprocessing')])
+
+    def test_run__should_get_budget__result_is_exit_when_exceeded(self):
+        """
+        Test startup budget.
+        """
+        temp_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            self.assertRaises(SystemExit, startup.run, ['--config', self.config, '--budget', '0'])
+            result = startup.run(['--config', self.config, '--budget', '60', '--json'])
+        finally:
+            sys.stdout.close()
+            sys.stdout = temp_stdout
+        self.assertLess(result['process_s'], 60)
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    """
+    Persisted view results tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'results.sqlite')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        sqlstore.connections.opened.clear()
+        utils.result_stores.clear()
+        shutil.rmtree(self.directory)
+
+    def test_get__should_get_other_data_version__result_is_none_and_deleted_on_put(self):
+        """
+        Test results of changed data are not served.
+        """
+        store = results.ResultStore(self.database)
+        self.assertIsNone(store.get('v1', 'a'))
+        store.put('v1', 'a', '[1]')
+        store.put('v1', 'b', '[2]')
+        self.assertEqual(store.get('v1', 'a'), '[1]')
+        self.assertIsNone(store.get('v2', 'a'))
+        store.put('v2', 'b', '[3]')
+        self.assertIsNone(store.get('v1', 'a'))
+        rows = store.connection().execute('SELECT key, version FROM results').fetchall()
+        self.assertListEqual(rows, [(u'b', u'v2')])
+
+    def test_connection__should_get_other_format__result_is_results_dropped(self):
+        """
+        Test results of other format are dropped.
+        """
+        results.ResultStore(self.database).put('v1', 'a', '[1]')
+        connection = sqlstore.connect(self.database, results.SCHEMA)
+        connection.execute('PRAGMA user_version = 0')
+        connection.commit()
+        self.assertIsNone(results.ResultStore(self.database).get('v1', 'a'))
+        self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], results.FORMAT)
+
+    def test_persisted__should_restart__result_is_stored_result_until_data_changes(self):
+        """
+        Test views serve persisted results of current data only.
+        """
+        path = os.path.join(self.directory, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        cache_temp = utils.data_cache
+        utils.data_cache = utils.LRUCache()
+        config = dict(main.app.config)
+        main.app.config.update({'DATA_CSV': path, 'DATA_SNAPSHOT': None, 'RESULTS_DATA': self.database})
+        client = main.app.test_client()
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        url = '/api/v1/mean_time_weekday/10?from=2013-09-10'
+        try:
+            expected = client.get(url, headers=headers).data
+            connection = sqlstore.connect(self.database, results.SCHEMA)
+            keys = [row[0] for row in connection.execute('SELECT key FROM results')]
+            self.assertEqual(len(keys), 1)
+            # a restarted process reads the stored body
+            connection.execute("UPDATE results SET body = '[\"stored\"]'")
+            connection.commit()
+            utils.result_stores.clear()
+            self.assertEqual(client.get(url, headers=headers).data, '["stored"]')
+            self.assertNotEqual(client.get('/api/v1/mean_time_weekday/10', headers=headers).data, '["stored"]')
+
+            with open(path, 'a') as stream:
+                stream.write('\n10,2013-09-16,09:00:00,17:00:00\n')
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+            utils.data_cache.clear()
+            result = client.get(url, headers=headers).data
+        finally:
+            main.app.config.clear()
+            main.app.config.update(config)
+            utils.data_cache = cache_temp
+            utils.loaders.pop(('memory', path), None)
+        self.assertNotEqual(result, '["stored"]')
+        self.assertNotEqual(result, expected)
+        self.assertEqual(json.loads(result)[0], [u'Mon', 28800.0])
+
 
 def suite():
     """
@@ -379,6 +2152,19 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(QuantileSketchTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceParserTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(ShardedLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(SQLiteStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(ResultStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(SnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PreforkServerTestCase))
+    base_suite.addTest(unittest.makeSuite(BenchmarkTestCase))
+    base_suite.addTest(unittest.makeSuite(RefresherTestCase))
+    base_suite.addTest(unittest.makeSuite(StartupTestCase))
+    base_suite.addTest(unittest.makeSuite(DownloadTestCase))
     return base_suite
 
 
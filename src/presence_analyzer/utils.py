@@ -2,29 +2,212 @@
 """
 Helper functions used in views.
 """
-import csv
+import calendar
+import glob
+import json
 import logging
 import os
-import requests
+import sys
+import tempfile
 import time
+import zlib
 
-from datetime import datetime
-from flask import Response
+from array import array
+from cStringIO import StringIO
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from datetime import date, datetime
+from flask import Response, abort, has_request_context, request
 from functools import wraps
-from json import dumps
+from hashlib import md5
+from importlib import import_module
+from presence_analyzer.ingest import make_loader
 from presence_analyzer.main import app
+from presence_analyzer.snapshot import file_mode
+from presence_analyzer.store import PresenceStore, weekday
 from threading import Lock
-from werkzeug.contrib.cache import SimpleCache
-from xml.etree import ElementTree as etree
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-lock = Lock()
-simple_cache = SimpleCache()
+loaders = {}  # pylint: disable=invalid-name
+# set while background Refresher keeps data up to date, requests then
+# never load files
+refreshing = False  # pylint: disable=invalid-name
 
+# JSON modules tried in order, simplejson has faster C speedups than
+# stdlib json and gives the same output
+JSON_SERIALIZERS = ('simplejson', 'json')
+# smaller bodies are not worth compressing
+COMPRESS_MIN_SIZE = 512
+COMPRESS_LEVEL = 6
+# size of pieces of streamed responses
+STREAM_BUFFER_SIZE = 64 * 1024
+# downloads of users.xml
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# lengths of periods of presence trend
+TREND_PERIODS = ('week', 'month')
+# percentiles of presence returned unless `percentiles` argument is given
+PERCENTILES = (50, 90)
 
-def cache(expires):
+
+class LRUCache(object):
+    """
+    Bounded cache of values with expiration time and LRU eviction.
+    Every key has its own lock used to compute missing values once,
+    the lock is kept while any thread holds or waits for it.
+    """
+
+    def __init__(self, max_size=256):
+        """
+        :param integer max_size:
+        """
+        self.max_size = max_size
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.key_locks = {}
+        self.stats = dict.fromkeys(
+            ['hits', 'misses', 'stale', 'recomputes', 'evictions'], 0
+        )
+
+    def get(self, key):
+        """
+        Gets (value, expires) pair for given key, also expired one.
+        :param mixed key:
+        :return tuple:
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def set(self, key, value, timeout):
+        """
+        Sets value for given key valid for timeout seconds.
+        :param mixed key:
+        :param mixed value:
+        :param integer timeout:
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + timeout)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def acquire(self, key, blocking=True):
+        """
+        Acquires lock of given key.
+        :param mixed key:
+        :param boolean blocking:
+        :return boolean: whether the lock was acquired
+        """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, [Lock(), 0])
+            key_lock[1] += 1
+        if key_lock[0].acquire(blocking):
+            return True
+        self.release(key, False)
+        return False
+
+    def release(self, key, locked=True):
+        """
+        Releases lock of given key, dropping it when nobody else uses it.
+        :param mixed key:
+        :param boolean locked: whether the caller holds the lock
+        """
+        with self.lock:
+            key_lock = self.key_locks[key]
+            key_lock[1] -= 1
+            if not key_lock[1]:
+                del self.key_locks[key]
+            if locked:
+                key_lock[0].release()
+
+    def count(self, name):
+        """
+        Increments counter.
+        :param string name:
+        """
+        with self.lock:
+            self.stats[name] += 1
+
+    def freeze(self):
+        """
+        Makes current entries never expire.
+        """
+        with self.lock:
+            for key, (value, _) in self.entries.items():
+                self.entries[key] = (value, float('inf'))
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+data_cache = LRUCache()  # pylint: disable=invalid-name
+users_cache = {}  # pylint: disable=invalid-name
+teams_cache = {}  # pylint: disable=invalid-name
+result_stores = {}  # pylint: disable=invalid-name
+
+
+def cache_stats():
+    """
+    Counters of cached results of functions.
+    :return dict:
+    """
+    with data_cache.lock:
+        return dict(data_cache.stats)
+
+
+def last_result(function):
     """
-    Cache user data.
+    Remembers result of the last call, arguments are compared by identity.
+    :param function function:
+    :return function:
+    """
+    last = [None, None]
+
+    @wraps(function)
+    def wrapper(*args):
+        """
+        Wrapper.
+        :param args:
+        :return mixed:
+        """
+        arguments, result = last
+        if arguments is None or len(arguments) != len(args) or any(
+                a is not b for a, b in zip(arguments, args)):
+            result = function(*args)
+            last[:] = [args, result]
+        return result
+    return wrapper
+
+
+def cache_key(function, args, kwargs):
+    """
+    Builds cache key from function name and arguments.
+    :param function function:
+    :param tuple args:
+    :param dict kwargs:
+    :return string:
+    """
+    return '{0}.{1}{2!r}{3!r}'.format(
+        function.__module__, function.__name__, args, sorted(kwargs.items())
+    )
+
+
+def cache(expires, stale=False):
+    """
+    Cache function results per arguments.
+    Missing value is computed by one thread while others wait for it.
+    With `stale` expired value is served while one thread refreshes it.
     :param integer expires:
+    :param boolean stale:
     :return function:
     """
     def decorator(function):
@@ -39,16 +222,33 @@ def cache(expires):
             Wrapper.
             :param args:
             :param kwargs:
-            :return list:
+            :return mixed:
             """
-            global lock
+            key = cache_key(function, args, kwargs)
+            entry = data_cache.get(key)
+            if entry is not None and entry[1] > time.time():
+                data_cache.count('hits')
+                return entry[0]
 
-            with lock:
-                data = simple_cache.get('user-data')
-                if data is None:
-                    data = function(*args, **kwargs)
-                    simple_cache.set('user-data', data, expires)
+            if entry is not None and stale:
+                if not data_cache.acquire(key, False):
+                    data_cache.count('stale')
+                    return entry[0]
+            else:
+                data_cache.count('misses')
+                data_cache.acquire(key)
+
+            try:
+                entry = data_cache.get(key)
+                if entry is not None and entry[1] > time.time():
+                    # computed by other thread while waiting for lock
+                    return entry[0]
+                data_cache.count('recomputes')
+                data = function(*args, **kwargs)
+                data_cache.set(key, data, expires)
                 return data
+            finally:
+                data_cache.release(key)
         return wrapper
     return decorator
 
@@ -56,29 +256,293 @@ def cache(expires):
 def get_users_data():
     """
     Get User data from xml.
+    The file is parsed again only when its mtime or size changes, while
+    refreshing in background only when refresh_data finds it changed.
+    :return dict:
+    """
+    path = app.config['USERS_DATA']
+    if refreshing and path in users_cache:
+        return users_cache[path][1]
+    return load_users_data(path)
+
+
+def load_users_data(path):
+    """
+    Parses users xml when its mtime or size changed.
+    :param string path:
     :return dict:
     """
-    users = {}
     try:
-        root = etree.parse(app.config['USERS_DATA'])
-        server = root.find('server')
-        port = server.find('port').text  # pylint: disable=no-member
-        protocol = server.find('protocol').text  # pylint: disable=no-member
-        host = server.find('host').text  # pylint: disable=no-member
-        for user in root.iter('user'):
-            id = int(user.get('id'))
-            name = user.find('name').text.encode('utf-8')
-            url = user.find('avatar').text.encode('utf-8')
-            avatar = "{0}://{1}:{2}{3}".format(protocol, host, port, url)
-            users[id] = {
-                'name': name,
-                'avatar': avatar
-            }
-    except IOError, e:
+        stat = os.stat(path)
+    except OSError:
         log.debug('File users.xml does not exist, run download-users command')
+        return {}
+
+    identity = (stat.st_mtime, stat.st_size)
+    cached = users_cache.get(path)
+    if cached is None or cached[0] != identity:
+        cached = (identity, parse_users_xml(path))
+        users_cache[path] = cached
+    return cached[1]
+
+
+def users_version():
+    """
+    Version of users data, changes with users.xml mtime or size.
+    :return string:
+    """
+    get_users_data()
+    cached = users_cache.get(app.config['USERS_DATA'])
+    return 'none' if cached is None else '{0!r}-{1}'.format(*cached[0])
+
+
+def get_teams_data():
+    """
+    Get team members from optional JSON file mapping team name to list of
+    user ids, TEAMS_DATA or teams.json next to USERS_DATA.
+    The file is parsed again only when its mtime or size changes.
+    :return dict:
+    """
+    path = teams_path()
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+
+    identity = (stat.st_mtime, stat.st_size)
+    cached = teams_cache.get(path)
+    if cached is None or cached[0] != identity:
+        with open(path) as stream:
+            teams = json.load(stream)
+        cached = (identity, dict(
+            (name, tuple(sorted(set(map(int, members)))))
+            for name, members in teams.iteritems()
+        ))
+        teams_cache[path] = cached
+    return cached[1]
+
+
+def teams_path():
+    """
+    Path of teams file.
+    :return string:
+    """
+    return app.config.get('TEAMS_DATA') or os.path.join(
+        os.path.dirname(app.config['USERS_DATA']), 'teams.json'
+    )
+
+
+def teams_version():
+    """
+    Version of teams data, changes with teams file mtime or size.
+    :return string:
+    """
+    get_teams_data()
+    cached = teams_cache.get(teams_path())
+    return 'none' if cached is None else '{0!r}-{1}'.format(*cached[0])
+
+
+def data_version():
+    """
+    Version of presence data.
+    :return string:
+    """
+    return get_data().version
+
+
+def date_range():
+    """
+    Day ordinals of `from` and `to` YYYY-MM-DD query arguments.
+    Missing argument gives None, invalid dates or empty range abort with 400.
+    :return tuple:
+    """
+    try:
+        return parse_date_range(
+            request.args.get('from'), request.args.get('to')
+        )
+    except ValueError as error:
+        log.debug('Invalid date range: %s', error)
+        abort(400)
+
+
+def parse_date_range(first, last):
+    """
+    Converts YYYY-MM-DD limits of date range to day ordinals.
+    Missing limit gives None.
+    :param string first:
+    :param string last:
+    :return tuple:
+    :raises ValueError: when date is invalid or range is empty
+    """
+    result = tuple(
+        None if value is None
+        else datetime.strptime(value, '%Y-%m-%d').toordinal()
+        for value in (first, last)
+    )
+    if None not in result and result[0] > result[1]:
+        raise ValueError('{0} is after {1}'.format(first, last))
+    return result
+
+
+def percentiles():
+    """
+    Comma separated percentiles of `percentiles` query argument, integers
+    from 1 to 100. Invalid values abort with 400.
+    :return tuple:
+    """
+    value = request.args.get('percentiles')
+    if value is None:
+        return PERCENTILES
+    try:
+        result = tuple(int(item) for item in value.split(','))
+    except ValueError:
+        result = ()
+    if not result or not all(1 <= item <= 100 for item in result):
+        log.debug('Invalid percentiles %s', value)
+        abort(400)
+    return result
+
+
+def parse_users_xml(path):
+    """
+    Parse users xml with iterparse, clearing elements as it goes.
+    :param string path:
+    :return dict:
+    """
+    from xml.etree import ElementTree as etree
+
+    users, server, urls = {}, {}, {}
+    for _, element in etree.iterparse(path):
+        if element.tag in ('port', 'protocol', 'host'):
+            server[element.tag] = element.text
+        elif element.tag == 'user':
+            user_id = int(element.get('id'))
+            users[user_id] = {
+                'name': element.findtext('name').encode('utf-8')
+            }
+            urls[user_id] = element.findtext('avatar').encode('utf-8')
+            element.clear()
+
+    for user_id, url in urls.iteritems():
+        users[user_id]['avatar'] = "{0}://{1}:{2}{3}".format(
+            server.get('protocol'), server.get('host'), server.get('port'), url
+        )
     return users
 
 
+@last_result
+def users_listing(data, users, avatars=frozenset()):
+    """
+    Serialized users listing, kept until presence, users data or cached
+    avatars change. Cached avatars are linked locally.
+    :param PresenceStore data:
+    :param dict users:
+    :param frozenset avatars: ids of users with cached avatar
+    :return JSONBody:
+    """
+    return JSONBody(dumps([
+        {
+            'user_id': i,
+            'name': users[i]['name'],
+            'avatar': '/avatars/{0}'.format(i) if i in avatars
+            else users[i]['avatar'],
+        }
+        for i in data.users() if i in users
+    ]))
+
+
+def http_session(retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """
+    Session reusing connections and retrying failed connections and
+    server errors with exponential backoff.
+    :param integer retries:
+    :param float backoff: base of delays between retries in seconds
+    :return requests.Session:
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download(url, path, session, timeout=DOWNLOAD_TIMEOUT,
+             chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Downloads url to path unless it is unchanged since previous download.
+    ETag and Last-Modified of the download are kept in `path`.validators
+    and sent back as conditional request. Body is streamed to a temporary
+    file renamed over path, so path is never partially written.
+    :param string url:
+    :param string path:
+    :param requests.Session session:
+    :param float timeout: seconds of connecting and of waiting for data
+    :param integer chunk_size:
+    :return boolean: whether the file was downloaded
+    """
+    validators_path = path + '.validators'
+    headers = {}
+    if os.path.exists(path):
+        try:
+            with open(validators_path) as stream:
+                validators = json.load(stream)
+        except (IOError, ValueError):
+            validators = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    with closing(response):
+        if response.status_code == 304:
+            log.debug('%s is not modified', url)
+            return False
+        response.raise_for_status()
+        # body shorter than Content-Length raises instead of being accepted
+        response.raw.enforce_content_length = True
+        with atomic_file(path) as stream:
+            for chunk in response.iter_content(chunk_size):
+                stream.write(chunk)
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+    with atomic_file(validators_path) as stream:
+        json.dump(validators, stream)
+    return True
+
+
+@contextmanager
+def atomic_file(path):
+    """
+    Opens temporary file in directory of path and renames it to path when
+    the block succeeds, otherwise removes it.
+    :param string path:
+    :return file:
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as stream:
+            yield stream
+        os.chmod(temp_path, file_mode())
+        os.rename(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
 def download_users_xml():
     """
     Download file.
@@ -86,97 +550,601 @@ def download_users_xml():
     root_dir = os.path.dirname(os.path.realpath(__file__))
     DEBUG_CFG = os.path.join('{0}/../../'.format(root_dir),'parts', 'etc', 'debug.cfg')
     app.config.from_pyfile(DEBUG_CFG)
+    from presence_analyzer.avatars import download_avatars
+
     url = app.config['USERS_DATA_EXTERNAL']
-    r = requests.get(url)
-    with open(app.config['USERS_DATA'], 'w') as f:
-        f.write(r.text.encode('ISO-8859-1'))
+    with closing(http_session()) as session:
+        if download(url, app.config['USERS_DATA'], session):
+            print 'Downloaded {0}'.format(url)
+        else:
+            print '{0} is not modified'.format(url)
+        result = download_avatars(
+            load_users_data(app.config['USERS_DATA']), session
+        )
+    print 'Avatars: {downloaded} downloaded, {not_modified} not modified,' \
+        ' {failed} failed'.format(**result)
+
+
+def load_serializer(names=JSON_SERIALIZERS):
+    """
+    Returns dumps function of first importable JSON module.
+    :param tuple names:
+    :return function:
+    """
+    for name in names:
+        try:
+            return import_module(name).dumps
+        except ImportError:
+            continue
+    raise ImportError('None of JSON modules {0} is available'.format(names))
+
+
+dumps = load_serializer()  # pylint: disable=invalid-name
+
+
+class JSONBody(str):
+    """
+    Already serialized JSON, sent by jsonify as it is.
+    Compressed variants are kept with the body, so reused bodies are
+    compressed only once.
+    """
+
+    def encode_as(self, encoding):
+        """
+        Returns body in given content coding.
+        :param string encoding: gzip or deflate
+        :return string:
+        """
+        encoded = self.__dict__.setdefault('encoded', {})
+        if encoding not in encoded:
+            encoded[encoding] = compress(self, encoding)
+        return encoded[encoding]
+
+
+def compress(body, encoding):
+    """
+    Compresses body with gzip or deflate content coding.
+    :param string body:
+    :param string encoding:
+    :return string:
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(
+            COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+        )
+        return compressor.compress(body) + compressor.flush()
+    return zlib.compress(body, COMPRESS_LEVEL)
+
+
+def accepted_encoding(size):
+    """
+    Picks content coding accepted by the client for body of given size.
+    :param integer size:
+    :return string: gzip, deflate or None when body is sent as it is
+    """
+    if size < app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE):
+        return None
+    for encoding in ('gzip', 'deflate'):
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
 
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+    Body is compressed when client accepts gzip or deflate.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
+        result = function(*args, **kwargs)
+        if not isinstance(result, JSONBody):
+            result = JSONBody(dumps(result))
+        if not has_request_context():
+            return Response(result, mimetype='application/json')
+
+        encoding = accepted_encoding(len(result))
+        response = Response(
+            result.encode_as(encoding) if encoding else result,
             mimetype='application/json'
         )
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
     return inner
 
 
-@cache(15)
+def xhr_only(function):
+    """
+    Rejects requests not made by XMLHttpRequest with 501.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        if not request.is_xhr:
+            log.debug('Not xhr request')
+            abort(501)
+        return function(*args, **kwargs)
+    return inner
+
+
+def persisted(function):
+    """
+    Keeps serialized results of the view in ResultStore of RESULTS_DATA
+    database, so they survive restarts. Results are stored per view
+    arguments and date range and served only for the data version they
+    were computed from. Without RESULTS_DATA results are not persisted.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        store = get_result_store()
+        if store is None:
+            return function(*args, **kwargs)
+
+        import sqlite3
+        key = repr(
+            (function.__name__,) + args + tuple(sorted(kwargs.items())) +
+            date_range()
+        )
+        version = data_version()
+        try:
+            body = store.get(version, key)
+        except sqlite3.Error:
+            log.exception('Cannot read result %s', key)
+            body = None
+        if body is not None:
+            return JSONBody(body)
+
+        result = function(*args, **kwargs)
+        body = result if isinstance(result, JSONBody) else JSONBody(
+            dumps(result)
+        )
+        try:
+            store.put(version, key, body)
+        except sqlite3.Error:
+            log.exception('Cannot store result %s', key)
+        return body
+    return inner
+
+
+def get_result_store():
+    """
+    ResultStore of RESULTS_DATA database, None when not configured.
+    :return ResultStore:
+    """
+    database = app.config.get('RESULTS_DATA')
+    if not database:
+        return None
+    store = result_stores.get(database)
+    if store is None:
+        from presence_analyzer.results import ResultStore
+        store = result_stores.setdefault(database, ResultStore(database))
+    return store
+
+
+def conditional(*versions):
+    """
+    Adds ETag derived from data versions and request URL to the response.
+    Request with matching If-None-Match gets 304 before the view is called.
+    :param versions: functions returning versions of data used by the view
+    :return function:
+    """
+    def decorator(function):
+        """
+        Decorator.
+        :param function function:
+        :return function:
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            etag = md5('\n'.join(
+                [request.path, request.query_string] +
+                [str(version()) for version in versions]
+            )).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.vary.add('Accept-Encoding')
+            else:
+                response = function(*args, **kwargs)
+            response.set_etag(etag, weak=True)
+            response.cache_control.no_cache = True
+            return response
+        return inner
+    return decorator
+
+
+@cache(15, stale=True)
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id. It creates structure like this.
-    data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
-    }
-    """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    Extracts presence data from CSV file into columnar PresenceStore.
+    Every row keeps user id, day ordinal and start/end seconds since midnight:
+    data.slice(10) == PresenceSlice(
+        days=array('i', [734777, 734778]),
+        starts=array('i', [32400, 30600]),
+        ends=array('i', [63000, 60300]),
+    )
+    Only lines appended since previous call are parsed when the file grew.
+    With DATA_SNAPSHOT configured the first call maps compiled snapshot.
+    DATA_CSV may also be a glob or list of files, see ShardedLoader.
+    """
+    return get_loader().load()
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
-
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+
+def get_loader():
+    """
+    Loader of DATA_CSV, a path, glob or list of them.
+    With DATA_BACKEND 'sqlite' the file is stored in DATA_SQLITE database,
+    by default data is kept in memory.
+    :return PresenceLoader, ShardedLoader or SQLiteLoader:
+    """
+    pattern = app.config['DATA_CSV']
+    key = pattern if isinstance(pattern, basestring) else tuple(pattern)
+    backend = app.config.get('DATA_BACKEND', 'memory')
+    loader = loaders.get((backend, key))
+    if loader is None:
+        if backend == 'sqlite':
+            check_config()
+            from presence_analyzer.sqlstore import SQLiteLoader
+            loader = SQLiteLoader(pattern, app.config['DATA_SQLITE'])
+        else:
+            loader = make_loader(
+                pattern,
+                app.config.get('DATA_SNAPSHOT'),
+                app.config.get('DATA_PROCESSES'),
+            )
+        loader = loaders.setdefault((backend, key), loader)
+    return loader
+
+
+def check_config():
+    """
+    Validates data configuration.
+    :raises ValueError: when DATA_CSV is a glob or a list of files while
+        DATA_BACKEND is 'sqlite', which ingests a single file
+    """
+    pattern = app.config['DATA_CSV']
+    if app.config.get('DATA_BACKEND', 'memory') == 'sqlite' and (
+            not isinstance(pattern, basestring) or glob.has_magic(pattern)):
+        raise ValueError(
+            "DATA_BACKEND 'sqlite' needs DATA_CSV to be a single file, "
+            "not {0!r}".format(pattern)
+        )
+
+
+def refresh_data():
+    """
+    Loads changed presence and users data and swaps it into caches,
+    where it does not expire until next refresh.
+    :return boolean: whether presence data changed
+    """
+    loader = get_loader()
+    previous = loader.data
+    data = loader.load()
+    data_cache.set(cache_key(get_data, (), {}), data, float('inf'))
+    load_users_data(app.config['USERS_DATA'])
+    return data is not previous
+
+
+def warm_up():
+    """
+    Loads presence, users and teams data and lists cached avatars, so the
+    first request is served as fast as the following ones.
+    :return PresenceStore:
+    """
+    from presence_analyzer.avatars import cached_avatars
+
+    data = get_data()
+    get_users_data()
+    get_teams_data()
+    cached_avatars()
     return data
 
 
+def org_weekday_stats(user_ids=None, first=None, last=None):
+    """
+    WeekdayStats summed over given users or whole organization.
+    :param tuple user_ids: team members, None for all users
+    :param integer first: first day ordinal or None
+    :param integer last: last day ordinal or None
+    :return tuple:
+    """
+    return total_stats(get_data().version, user_ids, first, last)
+
+
+@cache(3600)
+def total_stats(version, user_ids, first, last):
+    """
+    Sums WeekdayStats, cached per data version.
+    """
+    data = get_data()
+    log.debug('Summing stats of %s at %s', user_ids or 'all', version)
+    return data.total_stats(user_ids, first, last)
+
+
 def group_by_weekday(items):
     """
-    Groups presence entries by weekday.
+    Groups presence intervals of PresenceSlice by weekday.
     """
-    result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    # one array for every day in week
+    result = [array(PresenceStore.typecode) for _ in xrange(7)]
+    for day, start, end in zip(items.days, items.starts, items.ends):
+        result[weekday(day)].append(end - start)
     return result
 
 
 def group_by_weekday_start_end(items):
     """
-    Groups presence entries by weekday.
+    Groups presence starts and ends of PresenceSlice by weekday.
     """
-    result = {}  # one list for every day in week
+    result = {}
 
-    for date in items:
-        start, end = items[date]['start'], items[date]['end']
-        if date.weekday() not in result:
-            result[date.weekday()] = {
-                'weekday': date.strftime("%a"),
-                'start': [],
-                'end': []
+    for day, start, end in zip(items.days, items.starts, items.ends):
+        day = weekday(day)
+        if day not in result:
+            result[day] = {
+                'weekday': calendar.day_abbr[day],
+                'start': array(PresenceStore.typecode),
+                'end': array(PresenceStore.typecode)
             }
-        result[date.weekday()]['start'].append(seconds_since_midnight(start))
-        result[date.weekday()]['end'].append(seconds_since_midnight(end))
+        result[day]['start'].append(start)
+        result[day]['end'].append(end)
 
     return result
 
 
+def mean_time_weekday(stats):
+    """
+    Mean presence time per weekday from WeekdayStats.
+    """
+    return [
+        (calendar.day_abbr[day], ratio(entry.total, entry.count))
+        for day, entry in enumerate(stats)
+    ]
+
+
+def presence_weekday(stats):
+    """
+    Total presence time per weekday from WeekdayStats.
+    """
+    return [
+        (calendar.day_abbr[day], entry.total)
+        for day, entry in enumerate(stats)
+    ]
+
+
+def presence_start_end(stats):
+    """
+    Mean start and end per weekday from WeekdayStats, skips empty weekdays.
+    """
+    return dict(
+        (day, {
+            'weekday': calendar.day_abbr[day],
+            'start': stringify_seconds(ratio(entry.start, entry.count)),
+            'end': stringify_seconds(ratio(entry.end, entry.count)),
+        })
+        for day, entry in enumerate(stats) if entry.count
+    )
+
+
+def percentile_weekday(sketches, levels=PERCENTILES):
+    """
+    Percentiles of presence intervals, starts and ends in seconds per
+    weekday from QuantileSketch triples, skips empty weekdays.
+    :param tuple sketches:
+    :param tuple levels: percentiles from 1 to 100
+    :return list:
+    """
+    return [
+        dict(
+            [('weekday', calendar.day_abbr[day]), ('count', len(triple[0]))] +
+            [
+                (name, dict(
+                    ('p{0}'.format(value), sketch.quantile(value / 100.0))
+                    for value in levels
+                ))
+                for name, sketch in zip(('interval', 'start', 'end'), triple)
+            ]
+        )
+        for day, triple in enumerate(sketches) if len(triple[0])
+    ]
+
+
+def trend_periods(period, first, last):
+    """
+    Yields (first, last) day ordinals of weeks starting on Monday or of
+    calendar months covering inclusive range of day ordinals, clipped to
+    the range.
+    :param string period: week or month
+    :param integer first:
+    :param integer last:
+    :return generator:
+    """
+    start = first
+    while start <= last:
+        if period == 'week':
+            end = start - weekday(start) + 6
+        else:
+            day = date.fromordinal(start)
+            end = date(
+                day.year + day.month // 12, day.month % 12 + 1, 1
+            ).toordinal() - 1
+        yield start, min(end, last)
+        start = end + 1
+
+
+def presence_trend(data, user_id, period, first=None, last=None):
+    """
+    Total and mean presence of given user per week or month, in range of
+    `first` and `last` day ordinals clipped to days of the user.
+    Every period is summed from running sums of the weekday index, so it
+    costs a few binary searches whatever number of days it spans.
+    :param PresenceStore data:
+    :param integer user_id:
+    :param string period: week or month
+    :return list:
+    """
+    begin, end = data.day_range(user_id)
+    first = begin if first is None else max(first, begin)
+    last = end if last is None else min(last, end)
+    result = []
+    for start, stop in trend_periods(period, first, last):
+        stats = data.weekday_stats(user_id, start, stop)
+        count = sum(entry.count for entry in stats)
+        total = sum(entry.total for entry in stats)
+        result.append({
+            'start': date.fromordinal(start).isoformat(),
+            'end': date.fromordinal(stop).isoformat(),
+            'count': count,
+            'total': total,
+            'mean': ratio(total, count),
+        })
+    return result
+
+
+# statistics computed from WeekdayStats of a user, available in batches
+STATISTICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+
+def stream_json(items, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Yields JSON object built from (key, value) pairs in pieces of about
+    buffer_size bytes, so the whole document is never kept in memory.
+    :param iterable items:
+    :param integer buffer_size:
+    :return generator:
+    """
+    parts, size = ['{'], 1
+    for position, (key, value) in enumerate(items):
+        part = '{0}{1}: {2}'.format(
+            ', ' if position else '', dumps(str(key)), dumps(value)
+        )
+        parts.append(part)
+        size += len(part)
+        if size >= buffer_size:
+            yield ''.join(parts)
+            parts, size = [], 0
+    parts.append('}')
+    yield ''.join(parts)
+
+
+# columns of exported statistics, one record per user and weekday
+EXPORT_FIELDS = (
+    'user_id', 'weekday', 'count', 'total', 'mean', 'start', 'end'
+)
+
+
+def export_records(data, first=None, last=None):
+    """
+    Yields statistics of every user and weekday with presence entries.
+    :param PresenceStore data:
+    :param integer first: first day ordinal or None
+    :param integer last: last day ordinal or None
+    :return generator:
+    """
+    for user_id in data.users():
+        stats = data.weekday_stats(user_id, first, last)
+        for day, entry in enumerate(stats):
+            if not entry.count:
+                continue
+            yield (
+                user_id, calendar.day_abbr[day], entry.count, entry.total,
+                ratio(entry.total, entry.count),
+                ratio(entry.start, entry.count),
+                ratio(entry.end, entry.count),
+            )
+
+
+def export_csv(records, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Yields CSV with header in pieces of about buffer_size bytes.
+    :param iterable records:
+    :param integer buffer_size:
+    :return generator:
+    """
+    import csv
+
+    stream = StringIO()
+    writer = csv.writer(stream, lineterminator='\n')
+    writer.writerow(EXPORT_FIELDS)
+    for record in records:
+        writer.writerow(record)
+        if stream.tell() >= buffer_size:
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+    yield stream.getvalue()
+
+
+def export_ndjson(records, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Yields one JSON object per line in pieces of about buffer_size bytes.
+    :param iterable records:
+    :param integer buffer_size:
+    :return generator:
+    """
+    parts, size = [], 0
+    for record in records:
+        part = dumps(dict(zip(EXPORT_FIELDS, record))) + '\n'
+        parts.append(part)
+        size += len(part)
+        if size >= buffer_size:
+            yield ''.join(parts)
+            parts, size = [], 0
+    yield ''.join(parts)
+
+
+# writers and content types of export formats
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+}
+
+
+def export_statistics(argv=None):
+    """
+    Writes statistics of all users exported as CSV or NDJSON.
+    """
+    import argparse
+    from presence_analyzer.script import make_app
+
+    parser = argparse.ArgumentParser(description=export_statistics.__doc__)
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+                        default='csv')
+    parser.add_argument('--from', dest='first', help='YYYY-MM-DD')
+    parser.add_argument('--to', dest='last', help='YYYY-MM-DD')
+    parser.add_argument('--output', type=argparse.FileType('wb'),
+                        default=sys.stdout, help='file, standard output '
+                        'by default')
+    args = parser.parse_args(argv)
+
+    try:
+        first, last = parse_date_range(args.first, args.last)
+    except ValueError as error:
+        parser.error(str(error))
+
+    make_app(refresh=False)
+    writer = EXPORT_FORMATS[args.format][0]
+    for piece in writer(export_records(get_data(), first, last)):
+        args.output.write(piece)
+    args.output.flush()
+
+
 def avg_time_weekday(items):
     """
     Count avg for Groups presence entries by weekday.
@@ -191,7 +1159,14 @@ def stringify_average_date(list):
     """
     Stringify avg date
     """
-    return time.strftime("%Y %m %d %H:%M:%S", time.gmtime(mean(list)))
+    return stringify_seconds(mean(list))
+
+
+def stringify_seconds(seconds):
+    """
+    Stringify seconds since midnight as date of epoch.
+    """
+    return time.strftime("%Y %m %d %H:%M:%S", time.gmtime(seconds))
 
 
 def seconds_since_midnight(time):
@@ -212,4 +1187,11 @@ def mean(items):
     """
     Calculates arithmetic mean. Returns zero for empty lists.
     """
-    return float(sum(items)) / len(items) if len(items) > 0 else 0
+    return ratio(sum(items), len(items))
+
+
+def ratio(total, count):
+    """
+    Divides total by count. Returns zero when count is zero.
+    """
+    return float(total) / count if count > 0 else 0
@@ -2,19 +2,47 @@
 """
 Defines views.
 """
-import calendar
 import logging
+import os
 
-from flask import redirect, abort, request, render_template
+from flask import (
+    Response, redirect, abort, request, render_template, send_file
+)
+from presence_analyzer.avatars import (
+    AVATAR_MAX_AGE,
+    avatar_mimetype,
+    avatars_version,
+    cached_avatar,
+    cached_avatars
+)
 from presence_analyzer.main import app
+from presence_analyzer.metrics import registry
 from presence_analyzer.utils import(
-    avg_time_weekday,
+    EXPORT_FORMATS,
+    STATISTICS,
+    TREND_PERIODS,
+    cache_stats,
+    conditional,
+    data_version,
+    date_range,
+    export_records,
     get_data,
+    get_teams_data,
     get_users_data,
-    group_by_weekday,
-    group_by_weekday_start_end,
     jsonify,
-    mean
+    mean_time_weekday,
+    org_weekday_stats,
+    percentile_weekday,
+    percentiles,
+    persisted,
+    presence_start_end,
+    presence_trend,
+    presence_weekday,
+    stream_json,
+    teams_version,
+    users_listing,
+    users_version,
+    xhr_only
 )
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
@@ -46,83 +74,244 @@ def index(tab):
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@xhr_only
+@conditional(data_version, users_version, avatars_version)
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    if not request.is_xhr:
-        log.debug('Not xhr request')
-        abort(501)
+    return users_listing(get_data(), get_users_data(), cached_avatars())
 
-    data = get_data()
-    user_data = get_users_data()
-    return [
-        {'user_id': i, 'name': user_data.get(i).get('name'), 'avatar': user_data.get(i).get('avatar')}
-        for i in data.keys() if user_data.get(i)
-    ]
+
+@app.route('/avatars/<int:user_id>', methods=['GET'])
+def avatar_view(user_id):
+    """
+    Avatar of given user from the disk cache, fetched from intranet on
+    first request. Browsers keep it for AVATAR_MAX_AGE and revalidate it
+    with If-None-Match or If-Modified-Since.
+    """
+    path = cached_avatar(user_id)
+    if path is None:
+        log.debug('Avatar of %s not found!', user_id)
+        abort(404)
+
+    return send_file(
+        os.path.abspath(path),
+        mimetype=avatar_mimetype(path),
+        conditional=True,
+        cache_timeout=AVATAR_MAX_AGE,
+    )
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@xhr_only
+@conditional(data_version)
 @jsonify
+@persisted
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+    Optional `from` and `to` query arguments limit the date range.
     """
     data = get_data()
 
-    if not request.is_xhr:
-        log.debug('Not xhr request')
-        abort(501)
-
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    return mean_time_weekday(data.weekday_stats(user_id, *date_range()))
 
-    return result
+
+@app.route('/api/v1/percentile_weekday/<int:user_id>', methods=['GET'])
+@xhr_only
+@conditional(data_version)
+@jsonify
+def percentile_weekday_view(user_id):
+    """
+    Returns percentiles of presence time, start and end of given user
+    grouped by weekday, p50 and p90 unless `percentiles` query argument
+    lists others. Optional `from` and `to` query arguments limit the date
+    range.
+    """
+    data = get_data()
+
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    return percentile_weekday(
+        data.quantile_sketches(user_id, *date_range()), percentiles()
+    )
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@xhr_only
+@conditional(data_version)
 @jsonify
+@persisted
 def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+    Optional `from` and `to` query arguments limit the date range.
     """
     data = get_data()
 
-    if not request.is_xhr:
-        log.debug('Not xhr request')
-        abort(501)
-
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
+    result = presence_weekday(data.weekday_stats(user_id, *date_range()))
     result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@conditional(data_version)
 @jsonify
+@persisted
 def presence_start_end_view(user_id):
     """
     Return timeline data.
+    Optional `from` and `to` query arguments limit the date range.
     """
     data = get_data()
-    result = avg_time_weekday(
-        group_by_weekday_start_end(data[user_id])
+    return presence_start_end(data.weekday_stats(user_id, *date_range()))
+
+
+@app.route('/api/v1/presence_trend/<int:user_id>', methods=['GET'])
+@xhr_only
+@conditional(data_version)
+@jsonify
+def presence_trend_view(user_id):
+    """
+    Returns total and mean presence time of given user per week or month,
+    given by `period` query argument, week by default.
+    Optional `from` and `to` query arguments limit the date range.
+    """
+    period = request.args.get('period', TREND_PERIODS[0])
+    if period not in TREND_PERIODS:
+        log.debug('Unknown period %s', period)
+        abort(400)
+
+    data = get_data()
+
+    if user_id not in data:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    return presence_trend(data, user_id, period, *date_range())
+
+
+@app.route('/api/v1/batch', methods=['GET'])
+@conditional(data_version)
+def batch_view():
+    """
+    Returns statistics of many users as JSON object keyed by user id,
+    streamed in pieces. Users without presence data get null.
+    Query arguments:
+     - users: comma separated user ids or 'all' (default),
+     - stats: comma separated names of STATISTICS, all by default,
+     - from, to: optional YYYY-MM-DD limits of the date range.
+    """
+    data = get_data()
+    first, last = date_range()
+
+    stats = request.args.get('stats', ','.join(sorted(STATISTICS))).split(',')
+    unknown = [name for name in stats if name not in STATISTICS]
+    if unknown:
+        log.debug('Unknown statistics %s', unknown)
+        abort(400)
+
+    users = request.args.get('users', 'all')
+    if users == 'all':
+        user_ids = data.users()
+    else:
+        try:
+            user_ids = [int(user_id) for user_id in users.split(',')]
+        except ValueError:
+            log.debug('Invalid user ids %s', users)
+            abort(400)
+
+    def results():
+        """
+        Statistics of every requested user.
+        """
+        for user_id in user_ids:
+            if user_id not in data:
+                yield user_id, None
+                continue
+            weekdays = data.weekday_stats(user_id, first, last)
+            yield user_id, dict(
+                (name, STATISTICS[name](weekdays)) for name in stats
+            )
+
+    return Response(stream_json(results()), mimetype='application/json')
+
+
+@app.route('/api/v1/teams', methods=['GET'])
+@xhr_only
+@conditional(teams_version)
+@jsonify
+def teams_view():
+    """
+    Teams listing with their members.
+    """
+    teams = get_teams_data()
+    return [
+        {'team': name, 'users': list(teams[name])} for name in sorted(teams)
+    ]
+
+
+@app.route('/api/v1/org/<statistic>', methods=['GET'])
+@xhr_only
+@conditional(data_version, teams_version)
+@jsonify
+def org_view(statistic):
+    """
+    Returns statistic of STATISTICS computed over presence of all users
+    or of the team given in `team` query argument.
+    Optional `from` and `to` query arguments limit the date range.
+    """
+    if statistic not in STATISTICS:
+        log.debug('Statistic %s not found!', statistic)
+        abort(404)
+
+    team = request.args.get('team')
+    teams = get_teams_data()
+    if team is not None and team not in teams:
+        log.debug('Team %s not found!', team)
+        abort(404)
+
+    members = None if team is None else teams[team]
+    return STATISTICS[statistic](org_weekday_stats(members, *date_range()))
+
+
+@app.route('/api/v1/export.<extension>', methods=['GET'])
+@conditional(data_version)
+def export_view(extension):
+    """
+    Streams statistics of every user and weekday as csv or ndjson.
+    Optional `from` and `to` query arguments limit the date range.
+    """
+    if extension not in EXPORT_FORMATS:
+        log.debug('Export format %s not found!', extension)
+        abort(404)
+
+    data = get_data()
+    first, last = date_range()
+    writer, mimetype = EXPORT_FORMATS[extension]
+    return Response(
+        writer(export_records(data, first, last)), mimetype=mimetype
     )
 
-    return result
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Metrics of this process in Prometheus text format.
+    """
+    return Response(
+        registry.render(cache_stats()),
+        mimetype='text/plain; version=0.0.4'
+    )